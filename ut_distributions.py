@@ -1,12 +1,22 @@
 #!/usr/bin/env python
 
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import lru_cache
+from itertools import repeat
+from multiprocessing import shared_memory
+
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
+from scipy import sparse
 
 #import ut_fitter as utf
 #import ut_grapher as utg
-import ut_misc as utb
+import ut_kernels as utk
+import ut_metrics as utm
+import ut_storage as uts
 
 # This file is intended to deal with distribution processing. But it is kinda 
 # messy right now... Lots of half baked code because of project deadlines.  
@@ -14,6 +24,344 @@ import ut_misc as utb
 # operates on the distributions? That is kinda how the code is turning out as 
 # is.
 
+def _column_totals(values):
+    # Sum down each column in row order. np.sum switches to pairwise addition 
+    # depending on the memory layout, which would make the results depend on 
+    # how many columns are calculated at once.
+    return values.cumsum(axis=0)[-1]
+
+def _numeric_labels(labels):
+    # Float values of labels which are numbers or numeric strings (like 
+    # ut_misc.isnumeric) using one vectorized coercion instead of a python loop. 
+    # Other labels are NaN, except that numeric indices are all kept.
+    # Returns the values and the mask of the numeric labels.
+    labels = pd.Index(labels)
+    if pd.api.types.is_numeric_dtype(labels.dtype):
+        return labels.values.astype(np.float64), np.ones(labels.size, dtype=bool)
+    values = pd.to_numeric(labels.values, errors='coerce').astype(np.float64)
+    return values, ~np.isnan(values)
+
+def _numeric_rows(pd_data):
+    # Float size class labels and float values of the numeric rows of a 
+    # dataframe. Numeric string labels (such as from a csv with a header or 
+    # 'Total' row) become numbers.
+    sizes, numeric = _numeric_labels(pd_data.index)
+    values = np.asarray(pd_data.values[numeric], dtype=np.float64)
+    return sizes[numeric], values
+
+def _parse_run_times(runs):
+    # Sample times from run labels. Numeric labels are used as is; for text 
+    # labels (such as 't3070') the number at the end is used. Labels without 
+    # a number raise a ValueError.
+    runs = pd.Index(runs)
+    if pd.api.types.is_numeric_dtype(runs.dtype):
+        return runs.values.astype(np.float64)
+
+    numbers = runs.astype(str).str.extract(r'([-+]?\d*\.?\d+(?:[eE][-+]?\d+)?)\s*$')[0]
+    times = pd.to_numeric(numbers).values.astype(np.float64)
+    if np.isnan(times).any():
+        raise ValueError("Could not get times from run labels: {}".format(
+            list(runs[np.isnan(times)])))
+    return times
+
+def _read_sieve_file(path, reader=None, read_kwargs=None):
+    # Read one sieve file for PDDistributions.read_sieve_files. Returns the 
+    # numeric size classes, the run labels and the mass values (sizes x 
+    # runs). Excel files are read with pd.read_excel and everything else 
+    # with pd.read_csv, using the first column as the grain size index.
+    if reader is None:
+        extension = os.path.splitext(path)[1].lower()
+        excel = extension in ('.xls', '.xlsx', '.xlsm', '.ods')
+        reader = pd.read_excel if excel else pd.read_csv
+        read_kwargs = {'index_col' : 0, **(read_kwargs or {})}
+
+    df = reader(path, **(read_kwargs or {}))
+    sizes, values = _numeric_rows(df)
+
+    return sizes, list(df.columns), values
+
+def _normalized_cumsum(values, cumsummed=False):
+    # Normalized cumsum of each column of a mass array. Data which is already 
+    # a cumsum only needs to be normalized. The sums are always accumulated 
+    # in float64; the result has the dtype of values.
+    if cumsummed:
+        return values / values.max(axis=0)
+    else:
+        cumsum = values.cumsum(axis=0, dtype=np.float64)
+        return (cumsum / cumsum[-1]).astype(values.dtype, copy=False)
+
+def _distribution_statistics(cumsum, class_geometric_means):
+    # Moment statistics of each column of a normalized cumsum array in psi 
+    # units. See PDDistributions.calc_distribution_statistics. Returns an 
+    # array with one row per statistic (in statistic_names order).
+    psi_i = np.log2(class_geometric_means).reshape(-1,1)
+
+    # Fraction of grains in each class (the max_size row is not a class)
+    f_i = np.diff(cumsum[:-1,:], axis=0, prepend=0)
+    f_i = f_i / cumsum[-2,:]
+
+    av_psi = _column_totals(f_i * psi_i)
+    deviation = psi_i - av_psi
+    weighted = f_i * deviation
+
+    weighted = weighted * deviation
+    variance = _column_totals(weighted)
+    weighted = weighted * deviation
+    third_moment = _column_totals(weighted)
+    weighted = weighted * deviation
+    fourth_moment = _column_totals(weighted)
+
+    sorting = variance**.5
+    with np.errstate(divide='ignore', invalid='ignore'):
+        skewness = third_moment / sorting**3
+        kurtosis = fourth_moment / variance**2
+
+    statistics = np.array([2**av_psi, 2**sorting, sorting, skewness, kurtosis])
+    return statistics.astype(cumsum.dtype, copy=False)
+
+def _ks_normalize(cumsum):
+    # Normalize each column of a cumsum array by its maximum (see ks_test)
+    return cumsum / np.amax(cumsum, axis=0)
+
+def _compare_normalize_A(A_values):
+    # Comparison ready cumsum of A mass columns (see compare_distributions)
+    return _ks_normalize(_normalized_cumsum(A_values))
+
+def _compare_convert_B(A_sizes, B_sizes, B_values):
+    # Comparison ready cumsum of B mass columns, converted to the A size 
+    # classes (see compare_distributions)
+    lines = PiecewiseLinearCDF(B_sizes, _normalized_cumsum(B_values))
+    return _ks_normalize(lines.evaluate(A_sizes))
+
+def _pair_distances(An, Bn, out, metric, weights, max_memory=None):
+    # Fill out (n_A x n_B) with the metric (a ut_metrics.Metric) between 
+    # every pair of normalized A and B columns. Pairs are processed in tiles 
+    # that fit in max_memory bytes (see ks_test).
+    n_sizes, n_A = An.shape
+    n_B = Bn.shape[1]
+    A_tile, B_tile = PDDistributions.calc_tile_sizes(
+            n_sizes, n_A, n_B, max_memory, An.itemsize)
+
+    for a0 in range(0, n_A, A_tile):
+        a1 = min(a0 + A_tile, n_A)
+        for b0 in range(0, n_B, B_tile):
+            b1 = min(b0 + B_tile, n_B)
+            utk.pair_distances(metric, An[:,a0:a1], Bn[:,b0:b1], weights,
+                    out[a0:a1, b0:b1])
+
+def _ks_scores(A, B, sizes, metric, max_memory=None):
+    # Scores between every pair of A and B cumsum columns which share the 
+    # size classes (see ks_test). metric is a ut_metrics.Metric.
+    An = _ks_normalize(A)
+    Bn = _ks_normalize(B)
+    out = np.empty((An.shape[1], Bn.shape[1]), dtype=np.result_type(An, Bn))
+    _pair_distances(An, Bn, out, metric, metric.get_weights(sizes), max_memory)
+    return out
+
+def _compare_scores(A_sizes, A_values, B_sizes, B_values, metric, max_memory=None):
+    # Scores between every pair of A and B mass columns, with B converted to 
+    # the A size classes (see compare_distributions)
+    An = _compare_normalize_A(A_values)
+    Bn = _compare_convert_B(A_sizes, B_sizes, B_values)
+    out = np.empty((An.shape[1], Bn.shape[1]), dtype=np.result_type(An, Bn))
+    _pair_distances(An, Bn, out, metric, metric.get_weights(A_sizes), max_memory)
+    return out
+
+def _sink_blocks(blocks, shape, axis, out, to_frame, dtype=np.float64):
+    # Send (start, stop, values) blocks of a result to an output sink for the 
+    # chunked methods. Blocks cover rows (axis 0) or columns (axis 1) 
+    # start:stop of a result with the given shape. out is:
+    #  None  return a generator of partial dataframes (see to_frame)
+    #  array fill the array in place and return it
+    #  path  fill a new .npy file of dtype (memory mapped) and return the 
+    #        memmap
+    if out is None:
+        return (to_frame(start, stop, values) for start, stop, values in blocks)
+
+    if isinstance(out, (str, os.PathLike)):
+        out = np.lib.format.open_memmap(out, mode='w+', dtype=dtype,
+                shape=shape, fortran_order=(axis == 1))
+
+    for start, stop, values in blocks:
+        if axis == 0:
+            out[start:stop] = values
+        else:
+            out[:, start:stop] = values
+
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+
+# Process pool helpers for compare_distributions. Arrays are passed to the 
+# workers as (shared memory name, shape, dtype) specs so they are never 
+# pickled.
+def _create_shared(shape, dtype=np.float64):
+    dtype = np.dtype(dtype)
+    shm = shared_memory.SharedMemory(create=True,
+            size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def _attach_shared(spec):
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def _shared_normalize_A(A_spec, An_spec, a0, a1):
+    A_shm, A = _attach_shared(A_spec)
+    An_shm, An = _attach_shared(An_spec)
+    try:
+        An[:, a0:a1] = _compare_normalize_A(A[:, a0:a1])
+    finally:
+        del A, An
+        A_shm.close()
+        An_shm.close()
+
+def _shared_convert_B(A_sizes, B_sizes, B_spec, Bn_spec, b0, b1):
+    B_shm, B = _attach_shared(B_spec)
+    Bn_shm, Bn = _attach_shared(Bn_spec)
+    try:
+        Bn[:, b0:b1] = _compare_convert_B(A_sizes, B_sizes, B[:, b0:b1])
+    finally:
+        del B, Bn
+        B_shm.close()
+        Bn_shm.close()
+
+def _shared_distances(An_spec, Bn_spec, out_spec, a0, a1, b0, b1, metric_name, weights, max_memory):
+    An_shm, An = _attach_shared(An_spec)
+    Bn_shm, Bn = _attach_shared(Bn_spec)
+    out_shm, out = _attach_shared(out_spec)
+    try:
+        _pair_distances(An[:, a0:a1], Bn[:, b0:b1], out[a0:a1, b0:b1],
+                utm.get_metric(metric_name), weights, max_memory)
+    finally:
+        del An, Bn, out
+        An_shm.close()
+        Bn_shm.close()
+        out_shm.close()
+
+def _split(n, n_parts):
+    # Split range(n) into at most n_parts contiguous (start, stop) blocks
+    bounds = np.linspace(0, n, min(max(n_parts, 1), max(n, 1)) + 1).astype(int)
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+@lru_cache(maxsize=64)
+def _rebin_operator(source_sizes, target_sizes):
+    # Sparse (n_target x n_source) matrix which moves the mass in source 
+    # size classes to target size classes. Sizes are tuples of sorted class 
+    # minimum sizes. Cached by (source, target) so aligning many data sets 
+    # with the same classes builds the operator once.
+    #
+    # Mass is assumed to be spread evenly in log space within a class, so a 
+    # source class is split between the target classes it overlaps in 
+    # proportion to the overlap. Source classes that fit in one target class 
+    # are simply merged into it. Mass below the smallest target class goes 
+    # into that class and mass above the largest target size goes into the 
+    # largest class, so every column sums to one (mass is conserved).
+    #
+    # The largest source class has no known upper size, so all of its mass 
+    # goes to the target class containing its minimum size. (For 
+    # PDDistributions data that is the max_size row, which has no mass.)
+    x = np.log(np.asarray(source_sizes, dtype=np.float64))
+    y = np.log(np.asarray(target_sizes, dtype=np.float64))
+    n_source = x.size
+    n_target = y.size
+
+    # Target class bounds, open ended at both ends
+    y_min = np.concatenate([[-np.inf], y[1:]])
+    y_max = np.concatenate([y[1:], [np.inf]])
+
+    # Overlap of each source class with each target class
+    x_min = x[:-1]
+    x_max = x[1:]
+    overlap = (np.minimum(x_max, y_max.reshape(-1,1))
+            - np.maximum(x_min, y_min.reshape(-1,1)))
+    overlap = np.maximum(overlap, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = overlap / (x_max - x_min)
+
+    # Zero width classes and the largest class go wherever their minimum 
+    # size falls
+    point_classes = np.flatnonzero(x_max <= x_min)
+    weights[:, point_classes] = 0
+    point_classes = np.append(point_classes, n_source - 1)
+    weights = np.concatenate([weights, np.zeros((n_target, 1))], axis=1)
+    targets = np.searchsorted(y, x[point_classes], side='right') - 1
+    weights[np.maximum(targets, 0), point_classes] = 1
+
+    return sparse.csr_matrix(weights)
+
+
+class _RunBuffer:
+    # Growable 2D float array with runs for columns. Appending reallocates 
+    # with spare capacity (doubling), so adding a few runs at a time is 
+    # amortized O(new runs) instead of copying everything on every append.
+
+    __slots__ = ('values', 'n_runs')
+
+    def __init__(self, values):
+        # Float arrays keep their dtype (float32 or float64), anything else 
+        # is converted to float64
+        values = np.asarray(values)
+        if values.dtype.kind != 'f':
+            values = values.astype(np.float64)
+        self.values = values
+        self.n_runs = values.shape[1]
+
+    def view(self):
+        return self.values[:, :self.n_runs]
+
+    def append(self, values):
+        n_rows, capacity = self.values.shape
+        n_runs = self.n_runs
+        n_new = values.shape[1]
+        needed = n_runs + n_new
+
+        if needed > capacity:
+            grown = np.empty((n_rows, max(needed, 2 * capacity)),
+                    dtype=self.values.dtype, order='F')
+            grown[:, :n_runs] = self.view()
+            self.values = grown
+
+        self.values[:, n_runs:needed] = values
+        self.n_runs = needed
+
+
+# Calc method of each cached quantity (filled by _cached_property)
+_calc_names = {}
+
+def _cached_property(key, calc_name, to_frame=None, to_buffer=None):
+    # Make a property that is calculated by calling the calc_name method the 
+    # first time it is requested. The calc method is expected to store the 
+    # result by setting the property, which puts it in the instance cache.
+    #
+    # Quantities with one value per run are kept in a _RunBuffer so 
+    # append_runs can extend them. to_buffer converts a set value to the 
+    # buffer array and to_frame wraps the buffer array back up in labels.
+    _calc_names[key] = calc_name
+
+    def getter(self):
+        if key not in self._cache:
+            getattr(self, calc_name)()
+        value = self._cache[key]
+        if to_frame is None:
+            return value
+
+        if key not in self._frames:
+            self._frames[key] = to_frame(self, value.view())
+        return self._frames[key]
+
+    def setter(self, value):
+        if to_buffer is None:
+            self._set_cached(key, value)
+        else:
+            self._set_cached(key, _RunBuffer(to_buffer(value)))
+            self._frames[key] = value
+
+    return property(getter, setter)
+
+
 class PDDistributions:
 
     gravity = 9.81 # m/s^2
@@ -21,15 +369,76 @@ class PDDistributions:
     density_sediment = 2650 # kg/m^3
     slope = 0.02
 
+    # Percentiles calculated for the percentiles property
+    default_percentiles = [10, 16, 50, 84, 90]
+
+    # Number of runs per block for the chunked methods
+    default_block_size = 4096
+
+    # nearest_distributions switches to scoring every pair when more than 
+    # this share of the pairs were fully scored (checked from 
+    # nearest_check_runs A runs on), and then scores this many pairs per 
+    # block
+    nearest_exhaustive_share = 0.5
+    nearest_check_runs = 16
+    nearest_block_pairs = 2**20
+
+    # Columns of the statistics property
+    statistic_names = ['geometric_mean', 'geometric_std', 'sorting', 'skewness', 'kurtosis']
+
+    # Derived quantities and the cached quantities that must be recalculated 
+    # when they change.
+    _dependents = {
+            'cumsum' : ('line_matrix', 'percentiles', 'statistics'),
+            'class_geometric_means' : ('statistics',),
+            'line_matrix' : ('percentiles',),
+            }
+
+    # Derived quantities are calculated the first time they are requested 
+    # and cached until data or max_size change.
+    cumsum = _cached_property('cumsum', 'calc_normalized_cumsum',
+            to_frame=lambda self, values: pd.DataFrame(values,
+                index=self._sizes, columns=self._runs, copy=False),
+            to_buffer=lambda df: df.values)
+    class_geometric_means = _cached_property('class_geometric_means', 'calc_class_geometric_means')
+    line_matrix = _cached_property('line_matrix', 'calc_line_functions')
+    percentiles = _cached_property('percentiles', 'calc_percentiles',
+            to_frame=lambda self, values: pd.DataFrame(values.T,
+                index=self._runs, columns=PDDistributions.default_percentiles),
+            to_buffer=lambda df: df.values.T)
+    statistics = _cached_property('statistics', 'calc_distribution_statistics',
+            to_frame=lambda self, values: pd.DataFrame(values.T,
+                index=self._runs, columns=PDDistributions.statistic_names),
+            to_buffer=lambda df: df.values.T)
+
     # Methods
     # Perform calculations on internal distribution dataframe
-    def __init__(self, pd_data, max_size, auto=True, cumsummed=False):
+    def __init__(self, pd_data, max_size, auto=False, cumsummed=False, dtype=np.float64):
         # Assumes pd_data is formatted with grain size classes for rows and 
         # different distributions for columns. Smallest grain size class first
         #
         # Cumsummed indicates whether the provided data is a cumsum 
         # distribution or a regular distribution.
         #
+        # Derived quantities (cumsum, class_geometric_means, line_matrix, 
+        # percentiles, statistics) are calculated when first used. Auto 
+        # calculates the cumsum, class geometric means and line functions 
+        # right away instead.
+        #
+        # dtype is the float type of the data and everything calculated from 
+        # it (cumsum, line functions, percentiles, statistics). float32 
+        # halves the memory use. Cumsums are still accumulated in float64 
+        # before normalizing. Measured differences from the float64 results 
+        # (random runs of 30 size classes) are well below the precision of 
+        # sieve data:
+        #  percentile sizes                     about 1e-4 relative
+        #  geometric mean, geometric std,
+        #  sorting, kurtosis                    about 1e-4 relative
+        #  skewness                             about 1e-4 absolute
+        #  comparison scores                    about 1e-6 absolute
+        # Skewness can be near zero, so only its absolute difference is 
+        # bounded.
+        #
         # Will ignore non-numeric indices
         # 
         # Example:
@@ -47,43 +456,345 @@ class PDDistributions:
         #  5.6   3.11   2.11
         #  ...
 
-        # Remove non-numeric indices
-        indices = pd_data.index.values
-        numeric = [obj for obj in indices if utb.isnumeric(obj)]
-        self.data = pd_data.loc[pd.Index(numeric)]
-        self.max_size = max_size
+        self._cache = {}
+        self._frames = {}
+        self.cumsummed = cumsummed
 
-        # Set the maximum value by hand
-        if cumsummed:
-            # Don't know if the cumsum is normalized or not
-            previous = self.data.iloc[-1].max()
-            self.data.loc[max_size] =  previous if previous > 1 else 1
+        sizes, values = _numeric_rows(pd_data)
+
+        # Set the maximum value by hand. Replaces the max_size row if the 
+        # data already has one (such as the cumsum of another set).
+        max_row = self._calc_max_size_row(values)
+        existing = sizes == max_size
+        if existing.any():
+            mass = np.asfortranarray(values, dtype=dtype)
+            mass[existing] = max_row
         else:
-            # Not a cumsum distribution
-            self.data.loc[max_size] =  0
+            mass = np.empty((values.shape[0] + 1, values.shape[1]),
+                    dtype=dtype, order='F')
+            mass[:-1] = values
+            mass[-1] = max_row
+            sizes = np.append(sizes, max_size)
+
+        self._max_size = max_size
+        self._set_arrays(sizes, pd_data.columns, mass)
 
         if auto:
-            if cumsummed:
-                self.cumsum = self.data / self.data.max()
-            else:
-                self.calc_normalized_cumsum()
+            self.calc_normalized_cumsum()
             self.calc_class_geometric_means()
 
             self.calc_line_functions()
 
+    @property
+    def data(self):
+        # Grain size classes for rows (including the max_size row) and 
+        # distributions for columns
+        if 'data' not in self._frames:
+            self._frames['data'] = pd.DataFrame(self._mass.view(),
+                    index=self._sizes, columns=self._runs, copy=False)
+        return self._frames['data']
+
+    @data.setter
+    def data(self, data):
+        self._set_arrays(data.index, data.columns, data.values)
+
+    def _set_arrays(self, sizes, runs, mass):
+        # Use the mass array (size classes x runs, including the max_size 
+        # row) directly. Float arrays, including memmaps, aren't copied.
+        self._sizes = pd.Index(sizes)
+        self._run_labels = list(runs)
+        self._mass = _RunBuffer(mass)
+        self._cache.clear()
+        self._frames.clear()
+        self._frames['runs'] = pd.Index(runs)
+
+    @property
+    def _runs(self):
+        # Run labels as an index. Kept as a list internally so appending 
+        # doesn't copy the index every time.
+        if 'runs' not in self._frames:
+            self._frames['runs'] = pd.Index(self._run_labels)
+        return self._frames['runs']
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @property
+    def dtype(self):
+        # Float type of the data and derived quantities (see __init__)
+        return self._mass.values.dtype
+
+    @max_size.setter
+    def max_size(self, max_size):
+        # The maximum size is the label of the last data row. Sizes are made 
+        # float so a fractional max_size isn't truncated by integer classes.
+        sizes = np.append(self._sizes.values[:-1].astype(np.float64), max_size)
+
+        self._max_size = max_size
+        self._set_arrays(sizes, self._run_labels, self._mass.view())
+
+    def _set_cached(self, key, value):
+        # Store a derived quantity and drop the cached quantities which 
+        # depend on it
+        self._drop_cached(key)
+        self._cache[key] = value
+
+    def _set_buffer(self, key, values):
+        # Store a per run quantity array without making a labeled frame. The 
+        # frame is only made if the property is requested.
+        self._set_cached(key, _RunBuffer(values))
+
+    def _get_buffer(self, key):
+        # Per run quantity array (calculated if needed) without labels
+        if key not in self._cache:
+            getattr(self, _calc_names[key])()
+        return self._cache[key].view()
+
+    def _drop_cached(self, key):
+        self._cache.pop(key, None)
+        self._frames.pop(key, None)
+        for dependent in PDDistributions._dependents.get(key, ()):
+            self._drop_cached(dependent)
+
+    def _calc_max_size_row(self, values):
+        # Value of the max_size row added to the end of the data
+        if self.cumsummed:
+            # Don't know if the cumsum is normalized or not
+            previous = values[-1].max()
+            return previous if previous > 1 else 1
+        else:
+            # Not a cumsum distribution
+            return 0
+
+    def append_runs(self, pd_data):
+        # Add new distributions (columns) to the end of this set, such as a 
+        # new sieve sample from a running experiment. pd_data is formatted 
+        # the same way as for __init__ and must have the same size classes 
+        # (with or without the max_size row).
+        #
+        # Only the new columns are calculated. Any derived quantities which 
+        # have already been calculated are extended in place; the rest are 
+        # left for later.
+        #
+        # Cumsummed data shares one max_size row value (the largest value of 
+        # all the runs), which the cumsums are normalized by. If the new runs 
+        # raise it, the max_size row of every run is raised and the derived 
+        # quantities are dropped to be recalculated, like a rebuild would.
+        sizes, values = _numeric_rows(pd_data)
+        values = values.astype(self.dtype, copy=False)
+        runs = list(pd_data.columns)
+
+        if np.array_equal(sizes, self._sizes.values[:-1]):
+            max_row = self._calc_max_size_row(values)
+            values = np.concatenate([values, np.empty((1, values.shape[1]),
+                dtype=values.dtype)])
+        elif np.array_equal(sizes, self._sizes.values):
+            # Replace the max_size row like __init__ does
+            max_row = self._calc_max_size_row(values)
+            values = values.copy()
+        else:
+            raise ValueError("Size classes of the new runs do not match the existing size classes")
+
+        raised = False
+        if self.cumsummed and self._mass.n_runs > 0:
+            current = self._mass.view()[-1, 0]
+            raised = max_row > current
+            max_row = max(max_row, current)
+        values[-1] = max_row
+
+        cache = self._cache
+
+        self._mass.append(values)
+        self._run_labels.extend(runs)
+        self._frames.clear()
+
+        if raised:
+            self._mass.view()[-1] = max_row
+            self._drop_cached('cumsum')
+            return
+
+        if 'cumsum' not in cache:
+            return
+        cumsum = _normalized_cumsum(values, self.cumsummed)
+        cache['cumsum'].append(cumsum)
+
+        if 'line_matrix' in cache:
+            new_lines = PiecewiseLinearCDF(self._sizes.values, cumsum, runs)
+            cache['line_matrix'].append(new_lines)
+            if 'percentiles' in cache:
+                fractions = np.asarray(PDDistributions.default_percentiles) / 100
+                cache['percentiles'].append(new_lines.invert(fractions))
+
+        if 'statistics' in cache:
+            cache['statistics'].append(_distribution_statistics(cumsum,
+                    self.class_geometric_means.values))
+
+    def _from_arrays(sizes, runs, mass, max_size, cumsummed=False, cumsum=None):
+        # Make a PDDistributions straight from arrays without the cleaning 
+        # done by __init__. mass must already include the max_size row. 
+        # cumsum is an optional precalculated normalized cumsum.
+        distributions = PDDistributions.__new__(PDDistributions)
+        distributions._cache = {}
+        distributions._frames = {}
+        distributions.cumsummed = cumsummed
+        distributions._max_size = max_size
+        distributions._set_arrays(sizes, runs, mass)
+        if cumsum is not None:
+            distributions._cache['cumsum'] = _RunBuffer(cumsum)
+        return distributions
+
+    def from_store(store, mode='r'):
+        # Wrap a ut_storage.DistributionStore (or the path to one) without 
+        # copying. The data (and the cumsum, if the store has it) stay 
+        # memory mapped, so only the runs that are used get read from disk.
+        # Appending runs copies the data into memory.
+        if not isinstance(store, uts.DistributionStore):
+            store = uts.DistributionStore(store, mode)
+        return PDDistributions._from_arrays(store.sizes, store.runs,
+                store.mass, store.max_size, store.cumsummed, store.cumsum)
+
+    def read_sieve_files(source, max_size, reader=None, read_kwargs=None, workers=None, processes=False, executor=None, cumsummed=False, auto=False, dtype=np.float64):
+        # Make a PDDistributions from a set of sieve files. source is a 
+        # directory (every file in it), a glob pattern or a list of paths. 
+        # Files are read in sorted path order and every column becomes a 
+        # run. All files must have the same numeric size classes; 
+        # non-numeric rows (headers, totals, ...) are dropped.
+        #
+        # reader(path, **read_kwargs) returns a dataframe formatted like for 
+        # __init__. By default csv and excel files are read with pandas 
+        # using the first column as the index (see _read_sieve_file).
+        #
+        # Files are parsed in a thread pool, or a process pool if processes 
+        # is True (reader must then be picklable). workers sets the pool 
+        # size; executor can be any existing concurrent.futures executor. 
+        # The parsed columns are copied once into a preallocated matrix of 
+        # dtype (see __init__).
+        if isinstance(source, (str, os.PathLike)):
+            source = os.fspath(source)
+            if os.path.isdir(source):
+                source = os.path.join(source, '*')
+            paths = sorted(path for path in glob.glob(source) if os.path.isfile(path))
+        else:
+            paths = list(source)
+        if not paths:
+            raise ValueError("No sieve files found for {}".format(source))
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+        own_executor = executor is None
+        if own_executor:
+            executor = (ProcessPoolExecutor if processes else ThreadPoolExecutor)(workers)
+        try:
+            parsed = list(executor.map(_read_sieve_file, paths, repeat(reader),
+                    repeat(read_kwargs), chunksize=max(len(paths) // (4 * workers), 1)))
+        finally:
+            if own_executor:
+                executor.shutdown()
+
+        sizes = parsed[0][0]
+        n_runs = sum(values.shape[1] for _, _, values in parsed)
+        mass = np.empty((sizes.size + 1, n_runs), dtype=dtype, order='F')
+        runs = []
+        start = 0
+        for path, (file_sizes, file_runs, values) in zip(paths, parsed):
+            if not np.array_equal(file_sizes, sizes):
+                raise ValueError("Size classes in {} do not match those in {}".format(path, paths[0]))
+            stop = start + values.shape[1]
+            mass[:-1, start:stop] = values
+            runs.extend(file_runs)
+            start = stop
+
+        distributions = PDDistributions._from_arrays(np.append(sizes, max_size),
+                runs, mass, max_size, cumsummed)
+        mass[-1] = distributions._calc_max_size_row(mass[:-1])
+
+        if auto:
+            distributions.calc_normalized_cumsum()
+            distributions.calc_class_geometric_means()
+
+            distributions.calc_line_functions()
+
+        return distributions
+
+    def to_store(self, path, with_cumsum=True):
+        # Save to a ut_storage.DistributionStore at path and return the store
+        return uts.DistributionStore.write(path, self, with_cumsum)
+
+    def interpolate_times(self, query_times, times=None):
+        # Estimate distributions at the query times by linear interpolation 
+        # of the normalized cumsums of the two samples around each query 
+        # time. times is the sample time of each run; by default they are 
+        # parsed from the run labels (see _parse_run_times), so 't3070' is 
+        # time 3070. Query times outside of the sampled times get the first 
+        # or last sample.
+        #
+        # Returns a new PDDistributions (cumsummed) with the query times as 
+        # run labels, so percentiles (D50, D84, ...) and statistics at the 
+        # query times are available as usual. All the query times are done 
+        # at once with one searchsorted for the brackets.
+        times = _parse_run_times(self._runs) if times is None else np.asarray(times, dtype=np.float64)
+        query_times = np.asarray(query_times)
+        query = query_times.astype(np.float64)
+
+        order = np.argsort(times, kind='stable')
+        sorted_times = times[order]
+        n_runs = times.size
+
+        # Bracketing samples (side='right' so a query at a sample time uses 
+        # that sample with a weight of zero on the next one)
+        lower = np.clip(np.searchsorted(sorted_times, query, side='right') - 1,
+                0, max(n_runs - 2, 0))
+        upper = np.minimum(lower + 1, n_runs - 1)
+        t0 = sorted_times[lower]
+        t1 = sorted_times[upper]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weight = np.clip((query - t0) / (t1 - t0), 0, 1)
+        same = t1 == t0
+        weight[same] = query[same] >= t0[same]
+
+        cumsum = self._get_buffer('cumsum')
+        weight = weight.astype(cumsum.dtype)
+        values = (cumsum[:, order[lower]] * (1 - weight)
+                + cumsum[:, order[upper]] * weight)
+
+        return PDDistributions._from_arrays(self._sizes, query_times,
+                np.asfortranarray(values), self.max_size, cumsummed=True)
+
+    def select_runs(self, runs):
+        # New PDDistributions with only some of the runs. runs is a list of 
+        # run labels or a slice of run positions. A slice gives views of the 
+        # data and cumsum (no copying); a list only copies the selected 
+        # columns, so a memory mapped store only reads those runs.
+        if isinstance(runs, slice):
+            positions = runs
+        else:
+            positions = self._runs.get_indexer(runs)
+            if (positions < 0).any():
+                raise KeyError("Unknown runs: {}".format(
+                    [run for run, i in zip(runs, positions) if i < 0]))
+
+        cumsum = None
+        if 'cumsum' in self._cache:
+            cumsum = self._cache['cumsum'].view()[:, positions]
+
+        return PDDistributions._from_arrays(self._sizes, self._runs[positions],
+                self._mass.view()[:, positions], self.max_size,
+                self.cumsummed, cumsum)
 
     def get_size_classes(self):
-        return self.data.index.values
+        return self._sizes.values
 
     def calc_normalized_cumsum(self, data=None):
         if data is None:
-            self.cumsum =  self.data.cumsum() / self.data.sum()
+            values = _normalized_cumsum(self._mass.view(), self.cumsummed)
+            self._set_buffer('cumsum', values)
         else:
             return data.cumsum() / data.sum()
 
     def calc_class_geometric_means(self):
 
-        classes = self.data.index.get_values()
+        classes = self._sizes.values
         #n_classes = classes.size
         #offset = (np.arange(n_classes)+1)%n_classes
 
@@ -97,50 +808,40 @@ class PDDistributions:
 
         self.class_geometric_means =  pd.Series(Di, index=classes[:-1])
 
+    @property
+    def geometric_mean(self):
+        return self.statistics['geometric_mean']
+
     def calc_distribution_geometric_means(self):
-        # Calculate the geometric mean of each size class assuming the grain 
-        # size classes provided represent the minimum size in that class 
-        # (passing size)
+        # The geometric means are calculated along with the other moment 
+        # statistics. See calc_distribution_statistics.
+        self.calc_distribution_statistics()
+
+    def calc_distribution_statistics(self):
+        # Calculate the moment statistics of each distribution in psi units 
+        # assuming the grain size classes provided represent the minimum size 
+        # in that class (passing size)
         #
         # max_size represents the maximum size of the largest grain size class
         #
-        # Requires the output of calc_normalized_cumsum()
-        #
         # D_g = 2**av(psi)
         # av(psi) = sum[i=1->n](psi_i * f_i)
+        # sorting = sigma = (sum[i=1->n]((psi_i - av(psi))**2 * f_i))**(1/2)
+        # geometric std = 2**sigma
+        # skewness = sum[i=1->n]((psi_i - av(psi))**3 * f_i) / sigma**3
+        # kurtosis = sum[i=1->n]((psi_i - av(psi))**4 * f_i) / sigma**4
         # psi_i = (psi_b,i + psi_b,i+1)/2
         # psi_b,i = log2(D_i) = log(D_i)/log(2)
         # D_i == grain size for class i
         # f_i = f_f,i+1 - f_f,i == fraction of grains in this range
+        #
+        # All statistics are calculated for all runs at once and share the 
+        # psi_i, f_i and deviation arrays. Stored as the statistics dataframe 
+        # (runs for rows, statistic_names for columns).
 
-        # number of columns
-        distributions = cumsum_data.columns
-        n_distributions = distributions.size
-
-        # number of rows
-        size_classes = cumsum_data.index
-        n_size_classes = size_classes.size
-
-        # offest will be used for advanced indexing to identify class upper 
-        # values of each size class
-        offset = (np.arange(n_size_classes)+1)%n_size_classes
-        
-        # get the geometric means
-        psi_i = np.log2(class_geometric_means)
-
-        # Fraction of next bigger size class
-        cs = cumsum_data.values # Get numpy array of data
-        cs1 = cs[offset,:] # cs_i+1. Last row is garbage; will be max_size
-        cs1[-1,:] = np.ones(n_distributions) # manually set the last row to 100%
-
-        # Need to subtract rows as is (ignore the index labels)
-        f_i = pd.DataFrame(cs1 - cs, columns=distributions, index=size_classes)
-
-        psi = f_i.multiply(psi_i, axis=0)
-        av_psi = psi.sum(axis=0)
-
-        Dg = 2**av_psi
-        self.geometric_mean = Dg
+        values = _distribution_statistics(self._get_buffer('cumsum'),
+                self.class_geometric_means.values)
+        self._set_buffer('statistics', values)
 
     def calc_shear_stress(self, depth, slope):
         # shear = density gravity depth slope
@@ -149,100 +850,159 @@ class PDDistributions:
 
         self.shear_stresses = rho * g * depth * slope
 
-    def calc_fractional_transport():
+    def calc_fractional_transport(qb, transport, surface):
         # frac trans rate = q_b p_i / f_i
-        qb_key = condition_keys['qb']
-        qb = flow_conditions.loc[qb_key]
+        #
+        # qb is the bedload transport rate of each run (series indexed by run 
+        # or array in transport column order)
+        # transport is the transport grain size distribution (p_i) with size 
+        # classes for rows and runs for columns
+        # surface is the bed surface distribution (f_i), with the same runs 
+        # as transport or a single column used for every run
+        #
+        # Distributions can be masses or fractions; each column is normalized 
+        # to fractions. Transport is rebinned to the surface size classes if 
+        # they don't match (e.g. the extra 0.10mm transport class is merged 
+        # into 0.21mm).
+        #
+        # Output has surface size classes for rows and transport runs for 
+        # columns. Classes with no surface material are NaN.
+        sizes = surface.index.values
+        runs = transport.columns
 
-        fi = surface_data
-        
-        # For some reason, the trasport data has an extra size class (0.10mm).
-        # Combine 0.10mm with 0.21mm and delete 0.10mm
-        pi = transport_data.drop(0.10)
-        pi.loc[0.21] = transport_data.loc[0.10] + transport_data.loc[0.21]
+        transport = PDDistributions.rebin(transport, sizes)
+        if surface.columns.size > 1:
+            surface = surface.reindex(columns=runs)
 
-        fractional_rates = qb * (pi / fi)
+        pi = np.asarray(transport.values, dtype=np.float64)
+        fi = np.asarray(surface.values, dtype=np.float64)
+        pi = pi / _column_totals(pi)
+        fi = fi / _column_totals(fi)
 
-        return fractional_rates
+        if isinstance(qb, pd.Series):
+            qb = qb.reindex(runs)
+        qb = np.asarray(qb, dtype=np.float64)
+
+        ratio = np.divide(pi, fi, out=np.full(pi.shape, np.nan), where=fi > 0)
+        fractional_rates = qb * ratio
+
+        return pd.DataFrame(fractional_rates, index=sizes, columns=runs)
 
     def calc_line_functions(self):
-        # Generate a dataframe of line functions by linear interpolating 
-        # between cumsum rows. df[row,col] is the line from df[row,col] to 
-        # df[row+1,col]
+        # Generate the line functions by linear interpolating between cumsum 
+        # rows. Segment i of a run is the line from cumsum[i,run] to 
+        # cumsum[i+1,run]
         #
         # f_i(x) = m_i * x + y_i - m_i * x_i
         #
         # Recommended to change df such that anything outside of the defined 
         # distribution is a flat line. (add padding lines before/after df)
         
-        df = self.cumsum
-        length = df.index.size
-        index = df.index.values.reshape(length,1)
-        columns = df.columns
-        n = index.size
-
-        y = df.values # Get the numpy array out of df
-        y0 = y[:n-1,:]
-        y1 = y[1:, :]
-
-        x0 = index[:n-1]
-        x1 = index[1:]
-
-        m = (y1-y0) / (x1 - x0)
-        b = y0 - m * x0
-        
-        #print(m, b)
-
-        self.line_matrix = pd.Panel([m,b], items=['m','b'],
-                major_axis=index[:-1,:].ravel(), minor_axis=columns.ravel())
-        #self.line_matrix = np.array([m,b])
-        #self.line_slope = pd.DataFrame(m, index=index[:-1,:].ravel(), columns=columns.ravel())
-        #self.line_intercept = pd.DataFrame(b, index=index[:-1,:].ravel(), columns=columns.ravel())
+        self.line_matrix = PDDistributions.generate_line_functions(self.cumsum)
         
     def calc_percentile_size(self, percent):
         # Calculate the Di grain size where i is the percent less than, such as 
         # D50 or D84
+        #
+        # Returns one value per run (NaN if the run never crosses percent). 
+        # See calc_percentile_sizes for getting several percentiles at once.
         
         print("Calculating D{}...".format(percent))
-        fraction = percent / 100
-
-        cumsum = self.cumsum
-        np_cumsum = cumsum.values
-        lines = self.line_matrix
-        #line_slope = self.line_slope
-        #line_intercept = self.line_intercept
 
-        smaller = np_cumsum <= fraction
-        larger = np_cumsum > fraction
-        #print(cumsum)
-        #print(smaller)
-        #print(larger)
+        return self.calc_percentile_sizes([percent])[percent].values
 
-        sizes, runs = np.where(np.logical_and(smaller[:-1,:], larger[1:,:]))
-
-        #print(line_slope)
-        #print(line_intercept)
-        #print(sizes, runs)
-        #print(lines)
-        #print()
-        #m = lines['m']
-        #print(m)
-        #coefficients = np.extract(indices, lines)
-        coefficients = lines.values[:,sizes,runs]
-        #print(coefficients)
-
-        m = coefficients[0,:]
-        b = coefficients[1,:]
-        values = (fraction - b) / m
+    def calc_percentile_sizes(self, percents):
+        # Calculate the Di grain sizes for every percent in percents (such as 
+        # [10, 16, 50, 84, 90]) for every run at once.
+        #
+        # Returns a dataframe with runs for rows and percents for columns. 
+        # Runs that never cross a percent get NaN.
+        #
+        # See PiecewiseLinearCDF.invert for how the crossings are found.
+
+        percents = list(percents)
+        fractions = np.asarray(percents, dtype=np.float64) / 100
+
+        values = self.line_matrix.invert(fractions)
+
+        return pd.DataFrame(values.T, index=self.line_matrix.runs, columns=percents)
+
+    def calc_percentiles(self):
+        # Calculate the default_percentiles for the percentiles property
+        fractions = np.asarray(PDDistributions.default_percentiles, dtype=np.float64) / 100
+        self._set_buffer('percentiles', self.line_matrix.invert(fractions))
+
+    # Chunked methods
+    # Process the runs a block of columns at a time so memory use stays flat 
+    # for very large (e.g. memory mapped) data sets. Results go to an output 
+    # sink (see _sink_blocks) instead of the cache.
+    def iter_run_blocks(self, block_size=None, cumsum=False):
+        # Yield (start, stop, values) for blocks of block_size runs. values 
+        # are the data columns start:stop (views where possible), or their 
+        # normalized cumsum if cumsum is True. A cached cumsum is used when 
+        # there is one; otherwise it is calculated for one block at a time.
+        if block_size is None:
+            block_size = PDDistributions.default_block_size
+        n_runs = self._mass.n_runs
+        cached = self._cache.get('cumsum') if cumsum else None
+
+        for start in range(0, n_runs, block_size):
+            stop = min(start + block_size, n_runs)
+            if cached is not None:
+                values = cached.view()[:, start:stop]
+            else:
+                values = self._mass.view()[:, start:stop]
+                if cumsum:
+                    values = _normalized_cumsum(values, self.cumsummed)
+            yield start, stop, values
+
+    def calc_chunked(self, quantity, out=None, block_size=None, percents=None):
+        # Calculate a derived quantity one block of runs at a time. quantity 
+        # is 'cumsum', 'percentiles' or 'statistics' and the results are the 
+        # same as the properties of the same name. percents replaces 
+        # default_percentiles.
+        #
+        # out is where the results go:
+        #  None  a generator of partial dataframes, one per block
+        #  array an array of the full result shape, filled in place
+        #  path  a new .npy file (opened as a memmap and returned)
+        #
+        # Shapes are those of the properties: cumsum is sizes x runs, 
+        # percentiles and statistics are runs x (percents or statistics).
+        sizes = self._sizes
+        runs = self._runs
+        n_runs = self._mass.n_runs
+        blocks = self.iter_run_blocks(block_size, cumsum=True)
+
+        if quantity == 'cumsum':
+            return _sink_blocks(blocks, (sizes.size, n_runs), 1, out,
+                    lambda start, stop, values: pd.DataFrame(values,
+                        index=sizes, columns=runs[start:stop]), self.dtype)
+
+        if quantity == 'percentiles':
+            columns = list(PDDistributions.default_percentiles
+                    if percents is None else percents)
+            fractions = np.asarray(columns, dtype=np.float64) / 100
+            blocks = ((start, stop,
+                    PiecewiseLinearCDF(sizes.values, values).invert(fractions).T)
+                    for start, stop, values in blocks)
+        elif quantity == 'statistics':
+            columns = PDDistributions.statistic_names
+            class_means = self.class_geometric_means.values
+            blocks = ((start, stop, _distribution_statistics(values, class_means).T)
+                    for start, stop, values in blocks)
+        else:
+            raise ValueError("Unknown quantity '{}'. Options are: cumsum, percentiles, statistics".format(quantity))
 
-        return values
-        #print(cumsum.index.values[indices[0]])
+        return _sink_blocks(blocks, (n_runs, len(columns)), 0, out,
+                lambda start, stop, values: pd.DataFrame(values,
+                    index=runs[start:stop], columns=columns), self.dtype)
 
 
     # Class methods
     # Perform calculations (usually binary operations) on external distribution 
     # dataframes.
-    def compare_distributions(pd_distributions_A, pd_distributions_B, min_size=None, max_size=None):
+    def compare_distributions(pd_distributions_A, pd_distributions_B, min_size=None, max_size=None, max_memory=None, workers=None, executor=None, metric='sqrt_sum', dtype=np.float64):
         # Compare the distributions in A to Distributions in B. If 
         # distributions do not have matching grain sizes classes, they will be 
         # linearly interpolated
@@ -251,168 +1011,635 @@ class PDDistributions:
         # otherwise normalized data. Grain size should be the index and 
         # runs/times/etc should be the columns
         #
-        # Output will have indices (size classes) from A and columns from A
+        # Output has runs from A for rows and runs from B for columns
+        #
+        # metric is the name of the distance (see ks_test)
+        #
+        # max_memory limits the size of the comparison tiles (bytes, see 
+        # ks_test)
+        #
+        # workers or executor runs the calculations in a process pool. The A 
+        # and B columns are split into blocks and the cumsum, conversion and 
+        # distance stages are done block by block in the workers. Inputs, 
+        # intermediates and output live in shared memory. executor can be any 
+        # concurrent.futures process pool; workers sets the number of blocks 
+        # (defaults to the cpu count). The output is the same as the serial 
+        # version.
+        #
+        # dtype is the float type used for the calculations and the output 
+        # (see __init__ for float32 tolerances).
 
         A_raw = pd_distributions_A
         B_raw = pd_distributions_B
 
-        index_out = A_raw.index
-        columns_out = A_raw.columns
+        A_sizes, A_values, B_sizes, B_values = PDDistributions._comparison_arrays(
+                A_raw, B_raw, min_size, max_size, dtype)
+        metric = utm.get_metric(metric)
+        weights = metric.get_weights(A_sizes)
+
+        if workers is None and executor is None:
+            # Calculate normalized cumsum of A and B, convert B to match A 
+            # size classes, then compare input distributions to self 
+            # distributions (see ks_test)
+            distribution_fit = _compare_scores(A_sizes, A_values,
+                    B_sizes, B_values, metric, max_memory)
+        else:
+            distribution_fit = PDDistributions._compare_in_pool(
+                    A_sizes, A_values, B_sizes, B_values,
+                    metric, weights, max_memory, workers, executor)
+
+        return pd.DataFrame(distribution_fit,
+                index=A_raw.columns.values, columns=B_raw.columns.values)
+
+    def _comparison_arrays(A_raw, B_raw, min_size=None, max_size=None, dtype=np.float64):
+        # Get the size classes and mass arrays (of dtype) of A and B for 
+        # comparing, with B padded at min_size and max_size.
 
         # Fix raw_distributions classes
         # Make function for converting from A to B size classes
+        B_sizes, B_values = PDDistributions._pad_comparison_B(
+                B_raw, min_size, max_size, dtype)
 
-        # Pad the B distribution so that line segments on the ends will have 
-        # zero slope
-        B_index = B_raw.index.values
-        if max_size is not None and max_size not in B_index:
-            B_index = np.append(B_index, max_size)
-        if min_size is not None and min_size not in B_index:
-            B_index = np.insert(B_index, 0, min_size)
-        B_raw = B_raw.reindex(B_index, fill_value=0)
-
-        # Calculate non-normalized cumsum of A and B
-        rA_cumsum = A_raw.cumsum() / A_raw.sum()
-        rB_cumsum = B_raw.cumsum() / B_raw.sum()
-        #max_rB = rB_cumsum.
-
-        #print(rB_cumsum.index)
-        #print(rB_cumsum.columns)
-        #print(B_raw['t3070'])
-        #print(rB_cumsum['t3070'])
-
-        # Generate functions for line segments of B
-        rB_lines = PDDistributions.generate_line_functions(rB_cumsum)
-
-        # Convert B to match A size classes
-        A_index = A_raw.index.values
-        rB_a = PDDistributions.convert(A_index, rB_lines)
-
-        #fig = plt.figure()
-        #axis = plt.gca()
-        #B_raw.plot(ax=axis)
-        #rB_cumsum.plot()
-        #rB_a.plot(ax=axis)
-        #plt.show()
-        
-        # normalize the distributions
-        #A_cumsum = rA_cumsum / rA_cumsum.max(axis=0)
-        #Ba_cumsum = rB_a / rB_cumsum.max(axis=0)
+        A_sizes = np.asarray(A_raw.index.values, dtype=np.float64)
+        A_values = np.ascontiguousarray(A_raw.values, dtype=dtype)
 
-        # Compare input distributions to self distributions.
-        #  Use Kolmogorov-Smirnov test
-        distribution_fit = PDDistributions.ks_test(rA_cumsum, rB_a)
+        return A_sizes, A_values, B_sizes, B_values
+
+    def _pad_comparison_B(B_raw, min_size=None, max_size=None, dtype=np.float64):
+        # Pad the B distribution so that line segments on the ends will have 
+        # zero slope. Returns the padded size classes and mass array.
+        B_sizes = np.asarray(B_raw.index.values, dtype=np.float64)
+        B_mass = np.asarray(B_raw.values, dtype=dtype)
+        pad_max = max_size is not None and max_size not in B_sizes
+        pad_min = min_size is not None and min_size not in B_sizes
+        if pad_max:
+            B_sizes = np.append(B_sizes, max_size)
+        if pad_min:
+            B_sizes = np.insert(B_sizes, 0, min_size)
+
+        # Padding rows have zero mass
+        B_values = np.zeros((B_sizes.size, B_mass.shape[1]), dtype=dtype)
+        B_values[int(pad_min):int(pad_min) + B_mass.shape[0]] = B_mass
+
+        return B_sizes, B_values
+
+    def nearest_distributions(pd_distributions_A, pd_distributions_B, k=1, min_size=None, max_size=None, metric='sqrt_sum', n_probes=4, dtype=np.float64):
+        # Find the k distributions in B which are closest to each 
+        # distribution in A, using the same scores as compare_distributions 
+        # (lower is better). Inputs are the same as compare_distributions.
+        #
+        # Returns two dataframes with A runs for rows and ranks (0 is best) 
+        # for columns: the matching B run labels and their scores.
+        #
+        # The full A x B score matrix is never built. For each A run, B runs 
+        # are visited in order of a cheap lower bound on the score, the 
+        # difference of the weighted cumsum column totals (see 
+        # ut_metrics.Metric), and the search stops once that bound is worse 
+        # than the current k-th best score. Candidates are also screened with 
+        # a tighter bound before their exact score is calculated: the score 
+        # over only n_probes size classes combined with the total difference 
+        # bound over the remaining classes (see ut_metrics.Metric.combine).
+        #
+        # When the bounds don't rule out enough pairs (such as with very 
+        # similar distributions, or the 'ks' metric whose total difference 
+        # bound is divided by the number of size classes), the search costs 
+        # more than scoring every pair. If more than nearest_exhaustive_share 
+        # of the pairs of the first nearest_check_runs A runs (or any later 
+        # point) were fully scored, the remaining A runs score every pair 
+        # instead, a block at a time (see _nearest_exhaustive). The results 
+        # are the same either way.
+        A_raw = pd_distributions_A
+        B_raw = pd_distributions_B
+        A_sizes, A_values, B_sizes, B_values = PDDistributions._comparison_arrays(
+                A_raw, B_raw, min_size, max_size, dtype)
+        metric = utm.get_metric(metric)
+        weights = metric.get_weights(A_sizes).astype(dtype)
+
+        An = _compare_normalize_A(A_values)
+        Bn = _compare_convert_B(A_sizes, B_sizes, B_values)
+        n_sizes, n_A = An.shape
+        n_B = Bn.shape[1]
+        k = min(k, n_B)
+
+        probes = np.unique(np.linspace(0, n_sizes-1, n_probes).astype(int))
+        rest = np.setdiff1d(np.arange(n_sizes), probes)
+        probe_weights = weights[probes]
+        rest_weights = weights[rest]
+        A_probes = An[probes]
+        B_probes = Bn[probes]
+
+        weights_column = weights.reshape(-1,1)
+        A_totals = _column_totals(An * weights_column)
+        B_totals = _column_totals(Bn * weights_column)
+
+        # Weighted totals over the size classes which aren't probes. The rest 
+        # bound is left out if there are no such classes (or no weight on 
+        # them).
+        use_rest = rest.size > 0 and rest_weights.sum() > 0
+        if use_rest:
+            rest_column = rest_weights.reshape(-1,1)
+            A_rest = _column_totals(An[rest] * rest_column)
+            B_rest = _column_totals(Bn[rest] * rest_column)
+        order = np.argsort(B_totals, kind='stable')
+        sorted_totals = B_totals[order]
+        batch = max(4 * k, 256)
+
+        # Allow for rounding differences between the bounds and exact scores
+        slack = 1 + max(1e-9, 8 * n_sizes * np.finfo(dtype).eps)
+
+        best_index = np.empty((n_A, k), dtype=np.intp)
+        best_scores = np.empty((n_A, k), dtype=dtype)
+        n_scored = 0
+        for a in range(n_A):
+            if a >= PDDistributions.nearest_check_runs and \
+                    n_scored > PDDistributions.nearest_exhaustive_share * a * n_B:
+                best_index[a:], best_scores[a:] = PDDistributions._nearest_exhaustive(
+                        An[:, a:], Bn, k, metric, weights)
+                break
+
+            total = A_totals[a]
+            lo = hi = np.searchsorted(sorted_totals, total)
+            index = np.empty(0, dtype=np.intp)
+            scores = np.empty(0, dtype=dtype)
+            worst = np.inf
+
+            while lo > 0 or hi < n_B:
+                # Widen the window of B runs around this total
+                new_lo = max(lo - batch, 0)
+                new_hi = min(hi + batch, n_B)
+                candidates = np.concatenate([order[new_lo:lo], order[hi:new_hi]])
+                lo, hi = new_lo, new_hi
+
+                # Screen with the probe bound, then score the rest exactly
+                bound = utk.pair_distances(metric, A_probes[:, [a]], B_probes[:, candidates], probe_weights)[0]
+                if use_rest:
+                    bound = metric.combine(bound, metric.lower_bound(
+                        np.absolute(A_rest[a] - B_rest[candidates]), rest_weights))
+                candidates = candidates[bound <= worst * slack]
+                n_scored += candidates.size
+                if candidates.size:
+                    index = np.concatenate([index, candidates])
+                    scores = np.concatenate([scores,
+                        utk.pair_distances(metric, An[:, [a]], Bn[:, candidates], weights)[0]])
+                    if index.size > k:
+                        keep = np.argpartition(scores, k-1)[:k]
+                        index = index[keep]
+                        scores = scores[keep]
+                    if index.size == k:
+                        worst = scores.max()
+
+                # Nothing outside the window can beat the current k best
+                outside = min(total - sorted_totals[lo-1] if lo > 0 else np.inf,
+                        sorted_totals[hi] - total if hi < n_B else np.inf)
+                if metric.lower_bound(outside, weights) > worst * slack:
+                    break
+
+            ranked = np.argsort(scores, kind='stable')
+            best_index[a] = index[ranked]
+            best_scores[a] = scores[ranked]
+
+        return PDDistributions._nearest_frames(A_raw, B_raw, best_index, best_scores)
+
+    def _nearest_exhaustive(An, Bn, k, metric, weights):
+        # Top k search for nearest_distributions which scores every pair. 
+        # Blocks of A runs are scored against all of B (in tiles, see 
+        # _pair_distances) so only one block of scores is kept at a time. 
+        # Returns the best B indices and scores (n_A x k, best first).
+        n_A = An.shape[1]
+        n_B = Bn.shape[1]
+        dtype = np.result_type(An, Bn)
+        rows = max(1, min(n_A, PDDistributions.nearest_block_pairs // max(n_B, 1)))
+
+        best_index = np.empty((n_A, k), dtype=np.intp)
+        best_scores = np.empty((n_A, k), dtype=dtype)
+        for a0 in range(0, n_A, rows):
+            a1 = min(a0 + rows, n_A)
+            block = np.empty((a1 - a0, n_B), dtype=dtype)
+            _pair_distances(An[:, a0:a1], Bn, block, metric, weights)
+
+            index = np.argpartition(block, k-1, axis=1)[:, :k] if k < n_B \
+                    else np.broadcast_to(np.arange(n_B), block.shape)
+            scores = np.take_along_axis(block, index, axis=1)
+            ranked = np.argsort(scores, axis=1, kind='stable')
+            best_index[a0:a1] = np.take_along_axis(index, ranked, axis=1)
+            best_scores[a0:a1] = np.take_along_axis(scores, ranked, axis=1)
+
+        return best_index, best_scores
+
+    def _nearest_frames(A_raw, B_raw, best_index, best_scores):
+        # Label the nearest_distributions results
+        k = best_index.shape[1]
+        ranks = np.arange(k)
+        A_runs = A_raw.columns.values
+        matches = pd.DataFrame(B_raw.columns.values[best_index], index=A_runs, columns=ranks)
+        scores = pd.DataFrame(best_scores, index=A_runs, columns=ranks)
+
+        return matches, scores
+
+    def _compare_in_pool(A_sizes, A_values, B_sizes, B_values, metric, weights, max_memory, workers, executor):
+        # Process pool version of the compare_distributions calculations. 
+        # Returns the comparison matrix as a regular array.
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        n_sizes, n_A = A_values.shape
+        n_B = B_values.shape[1]
+        dtype = A_values.dtype
+
+        own_executor = executor is None
+        if own_executor:
+            executor = ProcessPoolExecutor(workers)
+
+        blocks = []
+        try:
+            def shared(shape):
+                shm, array = _create_shared(shape, dtype)
+                blocks.append(shm)
+                return (shm.name, shape, dtype.str), array
+
+            A_spec, A = shared(A_values.shape)
+            B_spec, B = shared(B_values.shape)
+            An_spec, _ = shared((n_sizes, n_A))
+            Bn_spec, _ = shared((n_sizes, n_B))
+            out_spec, out = shared((n_A, n_B))
+            A[:] = A_values
+            B[:] = B_values
+
+            # Cumsum and conversion stage, split by columns
+            futures = [executor.submit(_shared_normalize_A, A_spec, An_spec, a0, a1)
+                    for a0, a1 in _split(n_A, workers)]
+            futures += [executor.submit(_shared_convert_B, A_sizes, B_sizes, B_spec, Bn_spec, b0, b1)
+                    for b0, b1 in _split(n_B, workers)]
+            for future in wait(futures).done:
+                future.result()
+
+            # Distance stage, split into a grid of A x B blocks
+            A_blocks = _split(n_A, workers)
+            B_blocks = _split(n_B, -(-workers // max(len(A_blocks), 1)))
+            futures = [executor.submit(_shared_distances, An_spec, Bn_spec, out_spec,
+                    a0, a1, b0, b1, metric.name, weights, max_memory)
+                    for a0, a1 in A_blocks for b0, b1 in B_blocks]
+            for future in wait(futures).done:
+                future.result()
+
+            distribution_fit = out.copy()
+            del A, B, out
+        finally:
+            if own_executor:
+                executor.shutdown()
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
 
         return distribution_fit
         
     
     def generate_line_functions(df):
-        # Generate a dataframe of line functions by linear interpolating 
-        # between dataframe rows. df[row,col] is the line from df[row,col] to 
-        # df[row+1,col]
+        # Generate the line functions by linear interpolating between 
+        # dataframe rows. Segment i of a column is the line from df[i,col] to 
+        # df[i+1,col]
         #
         # f_i(x) = m_i * x + y_i - m_i * x_i
         #
+        # Returns a PiecewiseLinearCDF so the lines are stored as float 
+        # arrays and can be evaluated all at once.
+        #
         # Recommended to change df such that anything outside of the defined 
         # distribution is a flat line. (add padding lines before/after df)
-        
-        n = df.index.values.size
-        index = df.index.values.reshape(n,1)
-        columns = df.columns
-
-        y = df.values # Get the numpy array out of df
-        y0 = y[:n-1,:]
-        y1 = y[1:, :]
-
-        x0 = index[:n-1]
-        x1 = index[1:]
-
-        m = (y1-y0) / (x1 - x0)
-        b = y0 - m * x0
-
-        # Generate an array of line functions
-        line = lambda m_i, b_i: (lambda x: m_i * x + b_i) # define the line function
-        vfunc = np.vectorize(lambda fline, m_i, b_i: fline(m_i, b_i)) # vectorizing the line function
-        funcs = vfunc(line, m, b) # Creating the array of line functions
 
-        # Make dataframe of line functions
-        df_f = pd.DataFrame(funcs, index=index[:n-1].ravel(), columns=columns, dtype='object')
-
-        return df_f
+        return PiecewiseLinearCDF(df.index.values, df.values, df.columns)
         
 
     def convert(A_index, Bf):
         # Convert distributions for B so that the indices match those in A
-        # A is a cumsum dataframe
-        # Bf is a dataframe of functions (because A and B likely won't have the 
-        # same size classes). The functions could potentially be anything, but 
-        # linear interpolation functions are assumed.
-        #
-        # A and Bf must have grain sizes as index.
+        # A_index is the grain sizes (index) of the A cumsum dataframe
+        # Bf is the PiecewiseLinearCDF of B from generate_line_functions 
+        # (because A and B likely won't have the same size classes).
         #
-        # Output is a dataframe representing the converted B distribution
-        Bf_indices = Bf.index.values
-        Bf_times = Bf.columns.values
-
-        # Find the index of each size class of B relative to A
-        # This dictates which B function to use
-        # The -1 is because searchsorted is for inserting, whereas I want to 
-        # call the line function on the element to the left
-        arg_index = np.searchsorted(Bf_indices, A_index, side='left') - 1
-
-        # This is the size class for the above argument indices
-        arg_class = Bf_indices[arg_index]
+        # Output is a float dataframe representing the converted B 
+        # distribution
+        A_index = np.asarray(A_index)
+        values = Bf.evaluate(A_index)
 
-        # Could not figure out a better way of doing this....
-        out = pd.DataFrame(index=A_index, columns=Bf_times)
-        for time in Bf_times:
-            Bf_time = Bf[time]
-            funcs_df = Bf_time.loc[arg_class]
-
-            funcs = funcs_df.values
-            input = A_index
-
-            for f, gs in zip(funcs, input):
-                out.loc[gs, time] = f(gs)
+        out = pd.DataFrame(values, index=A_index, columns=Bf.runs)
 
         return out
 
-    def ks_test(A_df, B_df):
+    def ks_test(A_df, B_df, max_memory=None, metric='sqrt_sum'):
         # A_df is the non-normalized cumsum dataframe
         # B_df is the non-normalized B cumsum data converted to use A index 
         # (grain size)
         #
         # A_df and B_df must have grain sizes as index.
         #
-        # Output would ideally be a 3D array or dataframe: size x time x HS fit
+        # metric is the name of a distance in ut_metrics.metrics:
+        #  'sqrt_sum' square root of the summed absolute differences (the 
+        #             original score, not a true K-S statistic)
+        #  'ks' Kolmogorov-Smirnov statistic (largest absolute difference)
+        #  'wasserstein' earth mover's distance along the log2 size axis
+        #  'l2' L2 distance along the log2 size axis
+        #
+        # max_memory is the approximate number of bytes a size x A x B 
+        # distance tensor may use. If given, A and B runs are processed in 
+        # tiles that fit the budget and each tile is written straight into 
+        # the output matrix. None does all the runs in one tile.
         #
-        #XXXXXXXXX K_s test is the sum of the distribution differences squared
-        # K_s is more complicated than I can figure out at the moment. It is 
-        # based on the largest difference value between the distributions. I 
-        # will return that?
+        # Output has runs from A for rows and runs from B for columns
         
         A = A_df.values
         B = B_df.values
         index = A_df.index.values
         times = A_df.columns.values
         hs_times_str = B_df.columns.values
+        metric = utm.get_metric(metric)
 
-        # normalize distributions
-        An = A / np.amax(A, axis=0)
-        Bn = B / np.amax(B, axis=0)
+        # normalize distributions and score every pair
+        method_data = _ks_scores(A, B, index, metric, max_memory)
 
-        # Distance (absolute value) between distributions
-        dist = np.absolute(An[:,:,np.newaxis] - Bn[:,np.newaxis,:])
-
-        # Methods for 
-        #sup = np.amax(dist, axis=0)
-        sqrt_sum = np.sum(dist, axis=0)**.5
-
-        # Pick a method to actually return
-        method_data = sqrt_sum
         out_df = pd.DataFrame(data=method_data,
                 index=times, columns=hs_times_str)
 
         return out_df
 
+    def ks_test_chunked(A_df, B_df, out=None, block_size=None, max_memory=None, metric='sqrt_sum'):
+        # Same scores as ks_test, but only one block of A runs and one block 
+        # of B runs are normalized and held in memory at a time, so A_df and 
+        # B_df can be memory mapped (e.g. the cumsum of a PDDistributions 
+        # from a store). block_size is the number of runs per block and 
+        # max_memory limits the tiles within a block pair (see ks_test).
+        #
+        # out is a sink like in calc_chunked. Blocks are rows (A runs) of the 
+        # A x B score matrix; a generator yields one dataframe per A block.
+        if block_size is None:
+            block_size = PDDistributions.default_block_size
+        A = A_df.values
+        B = B_df.values
+        A_runs = A_df.columns
+        B_runs = B_df.columns
+        n_A = A.shape[1]
+        n_B = B.shape[1]
+        dtype = np.result_type(A, B)
+        metric = utm.get_metric(metric)
+        weights = metric.get_weights(A_df.index.values)
+
+        def blocks():
+            for a0 in range(0, n_A, block_size):
+                a1 = min(a0 + block_size, n_A)
+                An = _ks_normalize(A[:, a0:a1])
+                scores = np.empty((a1 - a0, n_B), dtype=dtype)
+                for b0 in range(0, n_B, block_size):
+                    b1 = min(b0 + block_size, n_B)
+                    _pair_distances(An, _ks_normalize(B[:, b0:b1]),
+                            scores[:, b0:b1], metric, weights, max_memory)
+                yield a0, a1, scores
+
+        return _sink_blocks(blocks(), (n_A, n_B), 0, out,
+                lambda start, stop, values: pd.DataFrame(values,
+                    index=A_runs[start:stop].values, columns=B_runs.values), dtype)
+
+    def calc_tile_sizes(n_sizes, n_A, n_B, max_memory=None, itemsize=8):
+        # Pick the number of A and B runs per tile so that a size x A x B 
+        # tile of the given itemsize fits in max_memory bytes. Tiles are kept 
+        # roughly square, but never smaller than a single pair. None means 
+        # everything in one tile.
+        if max_memory is None:
+            return max(n_A, 1), max(n_B, 1)
+
+        pairs = max(int(max_memory // (n_sizes * itemsize)), 1)
+        A_tile = min(max(int(pairs**.5), 1), max(n_A, 1))
+        B_tile = min(max(pairs // A_tile, 1), max(n_B, 1))
+
+        return A_tile, B_tile
+
+    def get_rebin_operator(source_sizes, target_sizes):
+        # Get the sparse operator which moves mass from the source size 
+        # classes to the target size classes (n_target x n_source). Sizes are 
+        # sorted class minimum sizes. See _rebin_operator for how mass is 
+        # split and merged. Operators are cached.
+        source = tuple(np.asarray(source_sizes, dtype=np.float64).tolist())
+        target = tuple(np.asarray(target_sizes, dtype=np.float64).tolist())
+        return _rebin_operator(source, target)
+
+    def rebin(pd_data, target_sizes):
+        # Move the mass of each distribution in pd_data (grain size classes 
+        # for rows, distributions for columns) into the target size classes 
+        # with a single sparse matrix product. Mass is conserved.
+        #
+        # Output has target_sizes for the index and the same columns
+        target_sizes = np.asarray(target_sizes)
+        source_sizes = pd_data.index.values
+        if np.array_equal(source_sizes, target_sizes):
+            return pd_data.copy()
+
+        operator = PDDistributions.get_rebin_operator(source_sizes, target_sizes)
+        values = operator @ np.asarray(pd_data.values, dtype=np.float64)
+
+        return pd.DataFrame(values, index=target_sizes, columns=pd_data.columns)
+
+
+class PiecewiseLinearCDF:
+    # Compact storage for a set of piecewise linear cumsum curves which share 
+    # the same breakpoints (grain sizes). Everything is kept in contiguous 
+    # float arrays so lookups don't go through pandas indexing.
+    #
+    # breakpoints is the sorted grain sizes (n_sizes)
+    # fractions is the cumsum value at each breakpoint (n_sizes x n_runs)
+    # slopes and intercepts are the line coefficients for the segment 
+    # starting at each breakpoint (n_sizes-1 x n_runs)
+    # runs is the list of run labels (only used for labelling outputs)
+    #
+    # Segment i of run j is the line from fractions[i,j] to 
+    # fractions[i+1,j]:
+    # f_i(x) = m_i * x + y_i - m_i * x_i
+
+    __slots__ = ('breakpoints', 'runs', '_fractions', '_slopes', '_intercepts')
+
+    def __init__(self, breakpoints, fractions, runs=None):
+        # The lines are calculated in float64 and stored in the dtype of 
+        # fractions (float32 or float64)
+        x = np.ascontiguousarray(breakpoints, dtype=np.float64)
+        y = np.asarray(fractions)
+        if y.dtype.kind != 'f':
+            y = y.astype(np.float64)
+        y64 = y.astype(np.float64, copy=False)
+        n = x.size
+        x = x.reshape(n,1)
+
+        y0 = y64[:n-1,:]
+        y1 = y64[1:, :]
+
+        x0 = x[:n-1]
+        x1 = x[1:]
 
+        m = (y1-y0) / (x1 - x0)
+        b = (y0 - m * x0).astype(y.dtype, copy=False)
+        m = m.astype(y.dtype, copy=False)
+
+        self.breakpoints = x.ravel()
+        self.runs = list(range(y.shape[1]) if runs is None else runs)
+        self._fractions = _RunBuffer(y)
+        self._slopes = _RunBuffer(m)
+        self._intercepts = _RunBuffer(b)
+
+    @property
+    def fractions(self):
+        return self._fractions.view()
+
+    @property
+    def slopes(self):
+        return self._slopes.view()
+
+    @property
+    def intercepts(self):
+        return self._intercepts.view()
+
+    def get_n_runs(self):
+        return self._fractions.n_runs
+
+    def append(self, lines):
+        # Add the runs of another PiecewiseLinearCDF with the same 
+        # breakpoints to the end of this one
+        if not np.array_equal(self.breakpoints, lines.breakpoints):
+            raise ValueError("Breakpoints do not match")
+
+        self._fractions.append(lines.fractions)
+        self._slopes.append(lines.slopes)
+        self._intercepts.append(lines.intercepts)
+        self.runs.extend(lines.runs)
+
+    def evaluate(self, sizes):
+        # Forward evaluation: fraction finer at each of the given sizes for 
+        # every run. Returns an array (n sizes x n_runs).
+        #
+        # Uses the segment starting to the left of each size (searchsorted is 
+        # for inserting, hence the -1). Sizes past the last segment start are 
+        # extrapolated from the last segment. See ut_kernels for the 
+        # numpy/numba backends.
+        return utk.evaluate(self.breakpoints, self.slopes, self.intercepts, sizes)
+
+    def invert(self, targets):
+        # Inverse evaluation: size at which each run first rises above each 
+        # target fraction. Returns an array (n targets x n_runs). Runs that 
+        # never cross a target get NaN.
+        #
+        # Each run is searched once for all the targets. The fractions are 
+        # made monotonic with a running max first, so the first segment that 
+        # rises above the target is used even if a run crosses it more than 
+        # once. Searching for the first value strictly larger than the target 
+        # skips flat segments, so the bracketing line never has zero slope. 
+        # See ut_kernels for the numpy/numba backends.
+        return utk.invert(self.fractions, self.slopes, self.intercepts, targets)
+
+
+class DistributionComparison:
+    # Score matrix of compare_distributions that is kept up to date as runs 
+    # are added to either side, such as when a new transport sample comes in 
+    # during an experiment. The comparison ready A cumsums, the B cumsums 
+    # converted to the A size classes and the scores are kept, so adding runs 
+    # only scores the new rows (A) or columns (B) against the existing runs.
+    #
+    # Inputs are formatted like for compare_distributions (mass values with 
+    # grain sizes for the index and runs for columns). Added runs must have 
+    # the same size classes as the first runs on their side. Scores are the 
+    # same as calling compare_distributions on all the runs.
+
+    def __init__(self, pd_distributions_A, pd_distributions_B, min_size=None, max_size=None, metric='sqrt_sum', max_memory=None, dtype=np.float64):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_memory = max_memory
+        self.metric = utm.get_metric(metric)
+        self.dtype = np.dtype(dtype)
+
+        A_raw = pd_distributions_A
+        B_raw = pd_distributions_B
+        self._B_raw_sizes = np.asarray(B_raw.index.values, dtype=np.float64)
+        A_sizes, A_values, B_sizes, B_values = PDDistributions._comparison_arrays(
+                A_raw, B_raw, min_size, max_size, dtype)
+        self.A_sizes = A_sizes
+        self.B_sizes = B_sizes
+        self.weights = self.metric.get_weights(A_sizes)
+
+        self.A_runs = list(A_raw.columns)
+        self.B_runs = list(B_raw.columns)
+        self._An = _RunBuffer(np.asfortranarray(_compare_normalize_A(A_values)))
+        self._Bn = _RunBuffer(np.asfortranarray(_compare_convert_B(A_sizes, B_sizes, B_values)))
+
+        n_A = self._An.n_runs
+        n_B = self._Bn.n_runs
+        self._scores = np.empty((n_A, n_B), dtype=self.dtype)
+        _pair_distances(self._An.view(), self._Bn.view(), self._scores,
+                self.metric, self.weights, max_memory)
+        self._n_A = n_A
+        self._n_B = n_B
+
+    @property
+    def An(self):
+        # Comparison ready A cumsums (A size classes x A runs)
+        return self._An.view()
+
+    @property
+    def Bn(self):
+        # Comparison ready B cumsums converted to the A size classes
+        return self._Bn.view()
+
+    @property
+    def scores(self):
+        # Score dataframe with A runs for rows and B runs for columns
+        return pd.DataFrame(self._scores[:self._n_A, :self._n_B],
+                index=self.A_runs, columns=self.B_runs, copy=False)
+
+    def _reserve(self, n_A, n_B):
+        # Make room in the score matrix for n_A x n_B scores (doubling like 
+        # _RunBuffer)
+        capacity_A, capacity_B = self._scores.shape
+        if n_A <= capacity_A and n_B <= capacity_B:
+            return
+        if n_A > capacity_A:
+            capacity_A = max(n_A, 2 * capacity_A)
+        if n_B > capacity_B:
+            capacity_B = max(n_B, 2 * capacity_B)
+
+        grown = np.empty((capacity_A, capacity_B), dtype=self.dtype)
+        grown[:self._n_A, :self._n_B] = self._scores[:self._n_A, :self._n_B]
+        self._scores = grown
+
+    def add_A(self, pd_data):
+        # Add A runs (mass columns with the A size classes) and score them 
+        # against every B run. Returns the new rows of scores.
+        if not np.array_equal(np.asarray(pd_data.index.values, dtype=np.float64), self.A_sizes):
+            raise ValueError("Size classes of the new A runs do not match the A size classes")
+        values = np.asarray(pd_data.values, dtype=self.dtype)
+        An = _compare_normalize_A(values)
+
+        a0 = self._n_A
+        a1 = a0 + An.shape[1]
+        self._reserve(a1, self._n_B)
+        _pair_distances(An, self.Bn, self._scores[a0:a1, :self._n_B],
+                self.metric, self.weights, self.max_memory)
+
+        self._An.append(An)
+        self.A_runs.extend(pd_data.columns)
+        self._n_A = a1
+
+        return self.scores.iloc[a0:a1]
+
+    def add_B(self, pd_data):
+        # Add B runs (mass columns with the B size classes) and score them 
+        # against every A run. Returns the new columns of scores.
+        if not np.array_equal(np.asarray(pd_data.index.values, dtype=np.float64), self._B_raw_sizes):
+            raise ValueError("Size classes of the new B runs do not match the B size classes")
+        B_sizes, B_values = PDDistributions._pad_comparison_B(
+                pd_data, self.min_size, self.max_size, self.dtype)
+        Bn = _compare_convert_B(self.A_sizes, B_sizes, B_values)
+
+        b0 = self._n_B
+        b1 = b0 + Bn.shape[1]
+        self._reserve(self._n_A, b1)
+        _pair_distances(self.An, Bn, self._scores[:self._n_A, b0:b1],
+                self.metric, self.weights, self.max_memory)
+
+        self._Bn.append(Bn)
+        self.B_runs.extend(pd_data.columns)
+        self._n_B = b1
+
+        return self.scores.iloc[:, b0:b1]
@@ -1,19 +1,46 @@
 #!/usr/bin/env python
 
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 from scipy import optimize
 
+def _bootstrap_linear_chunk(x, y, n_resamples, seed):
+    # Least squares slopes and intercepts of n_resamples bootstrap resamples 
+    # of the (centered) x and y arrays. All the resample indices are drawn 
+    # as one array and turned into counts of each point, so the sums for 
+    # every resample come from one matrix product.
+    rng = np.random.default_rng(seed)
+    n = x.size
+    index = rng.integers(0, n, size=(n_resamples, n))
+    index += n * np.arange(n_resamples).reshape(-1,1)
+    counts = np.bincount(index.ravel(), minlength=n_resamples * n)
+    counts = counts.reshape(n_resamples, n).astype(np.float64)
+
+    sums = counts @ np.column_stack([x, y, x * y, x * x])
+    sum_x, sum_y, sum_xy, sum_xx = sums.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slopes = (n * sum_xy - sum_x * sum_y) / (n * sum_xx - sum_x**2)
+    intercepts = (sum_y - slopes * sum_x) / n
+
+    return slopes, intercepts
+
 class Fitter:
 
-    def get_power_fit(x_series, y_series, guess=[1,1], return_power=True):
+    def get_power_fit(x_series, y_series, guess=[1,1], return_power=True, robust=None, max_pairs=10**6, seed=None):
         # Perform a least squares linear fit in log space to get a power law 
         # relationship. Can return either a, b from y = ax^b or log_m, log_b from 
         # log(y) = log_m * log(x) + log_b, depending on "return_power".
+        #
+        # robust uses a robust fit instead of least squares (see 
+        # get_robust_fit, which max_pairs and seed are passed to).
         
         log_x = np.log10(x_series)
         log_y = np.log10(y_series)
 
-        log_m, log_b = Fitter.get_linear_fit(log_x, log_y, guess)
+        log_m, log_b = Fitter.get_linear_fit(log_x, log_y, guess,
+                robust=robust, max_pairs=max_pairs, seed=seed)
 
         #     log_y  =      log_m * log_x  + log_b
         # 10**log(y) = 10**(log_m * log(x) + log_b)
@@ -30,6 +57,62 @@ class Fitter:
             # Returns the slope and y-intercept in log space
             return log_m, log_b
 
+    def bootstrap_power_fit(x_series, y_series, n_resamples=10000, confidence=95, seed=None, workers=None, executor=None, chunk_size=1000):
+        # Bootstrap percentile confidence intervals for the power law fit 
+        # y = ax^b of get_power_fit. Every resample is fit with the closed 
+        # form least squares line in log space (see _bootstrap_linear_chunk).
+        #
+        # Resamples are done in chunks of chunk_size. Each chunk gets its own 
+        # seed spawned from seed (a np.random.SeedSequence or anything it 
+        # accepts), so the results only depend on seed and chunk_size, not on 
+        # the number of workers. workers or executor runs the chunks in a 
+        # process pool; executor can be any concurrent.futures executor.
+        #
+        # Returns a, b, (a_low, a_high), (b_low, b_high) where a and b are 
+        # the fit of all the data.
+        log_x = np.log10(np.asarray(x_series, dtype=np.float64))
+        log_y = np.log10(np.asarray(y_series, dtype=np.float64))
+        valid = np.isfinite(log_x) & np.isfinite(log_y)
+        log_x = log_x[valid]
+        log_y = log_y[valid]
+
+        # Center the data so the raw sums don't lose precision
+        x_mean = log_x.mean()
+        y_mean = log_y.mean()
+        x = log_x - x_mean
+        y = log_y - y_mean
+
+        sizes = [min(chunk_size, n_resamples - start)
+                for start in range(0, n_resamples, chunk_size)]
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+
+        if workers is None and executor is None:
+            chunks = [_bootstrap_linear_chunk(x, y, size, chunk_seed)
+                    for size, chunk_seed in zip(sizes, seeds)]
+        else:
+            own_executor = executor is None
+            if own_executor:
+                executor = ProcessPoolExecutor(workers or os.cpu_count() or 1)
+            try:
+                chunks = list(executor.map(_bootstrap_linear_chunk,
+                    [x] * len(sizes), [y] * len(sizes), sizes, seeds))
+            finally:
+                if own_executor:
+                    executor.shutdown()
+
+        log_m = np.concatenate([slopes for slopes, _ in chunks])
+        log_b = np.concatenate([intercepts for _, intercepts in chunks])
+        log_b = log_b + y_mean - log_m * x_mean
+
+        tail = (100 - confidence) / 2
+        percents = [tail, 100 - tail]
+        a_interval = tuple(10**np.nanpercentile(log_b, percents))
+        b_interval = tuple(np.nanpercentile(log_m, percents))
+
+        slopes, intercepts, _ = Fitter._batched_linear_fit(
+                log_x.reshape(1,-1), log_y.reshape(1,-1))
+        return 10**intercepts[0], slopes[0], a_interval, b_interval
+
     def get_power_fit_series(axis, x_series, y_series, guess=[1,1], truncate_box=(None, None, None, None)):
         fit = Fitter.get_power_fit(x_series, y_series, guess, return_power=False)
         if VERBOSE:
@@ -39,7 +122,7 @@ class Fitter:
         # Get a series of points in log space and return the linear values.
         return Fitter.get_linear_series(axis, *fit, log_space=True, truncate_box=truncate_box)
 
-    def get_linear_fit(x_series, y_series, guess=[1,1], pass_through=None):
+    def get_linear_fit(x_series, y_series, guess=[1,1], pass_through=None, robust=None, max_pairs=10**6, seed=None):
         # Perform a least squares linear fit to the given data series constrained 
         # to passing through the given point, or unconstrained if no point is 
         # provided.
@@ -48,6 +131,15 @@ class Fitter:
         #
         # If you are defining a pass_through point, then guess must only have one 
         # value (for the slope).
+        #
+        # robust is the name of a robust method ('theil_sen' or 
+        # 'repeated_median') to use instead of least squares. See 
+        # get_robust_fit, which max_pairs and seed are passed to; guess isn't 
+        # used.
+        if robust is not None:
+            return Fitter.get_robust_fit(x_series, y_series, pass_through,
+                    robust, max_pairs, seed)
+
         if pass_through:
             # Constrained to pass through a point. Find slope.
             ptx, pty = pass_through
@@ -68,6 +160,153 @@ class Fitter:
 
         return best_m, best_b
 
+    def fit_many(x_stack, y_stack, pass_through=None, log_space=False, return_power=True):
+        # Closed form least squares linear fits for many series at once, such 
+        # as velocity, depth and width against discharge for every reach. 
+        # Gives the same fits as get_linear_fit (or get_power_fit with 
+        # log_space) called on each series, without the iterative solver.
+        #
+        # x_stack and y_stack are 2D arrays with one series per row. Series 
+        # of different lengths can be padded with NaN; points where x or y 
+        # is NaN (or not positive, in log space) are ignored. x_stack can 
+        # also be 1D if every series has the same x values.
+        #
+        # pass_through is an (x, y) point every line is constrained to pass 
+        # through, or None for unconstrained fits. For log space fits it is 
+        # a point in linear space (converted to log10 like the data).
+        #
+        # Returns arrays (one value per series) of slope, intercept and R^2 
+        # (of the fit in linear or log space). Log space fits return a, b 
+        # from y = ax^b instead of the slope and intercept if return_power, 
+        # like get_power_fit. Series with too few points get NaN.
+        x = np.asarray(x_stack, dtype=np.float64)
+        y = np.asarray(y_stack, dtype=np.float64)
+        x = np.broadcast_to(x, y.shape) if x.ndim < y.ndim else x
+        x, y = np.atleast_2d(x), np.atleast_2d(y)
+
+        if log_space:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x = np.log10(x)
+                y = np.log10(y)
+            if pass_through is not None:
+                pass_through = np.log10(pass_through)
+
+        slopes, intercepts, r_squared = Fitter._batched_linear_fit(x, y, pass_through)
+
+        if log_space and return_power:
+            return 10**intercepts, slopes, r_squared
+        return slopes, intercepts, r_squared
+
+    def _batched_linear_fit(x, y, pass_through=None):
+        # Least squares lines for each row of the 2D arrays x and y, ignoring 
+        # points where either isn't finite. Returns slopes, intercepts and 
+        # R^2 arrays.
+        mask = np.isfinite(x) & np.isfinite(y)
+        n = mask.sum(axis=1)
+        x = np.where(mask, x, 0)
+        y = np.where(mask, y, 0)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            y_mean = y.sum(axis=1) / n
+            if pass_through is None:
+                # Centered sums around the means
+                x_center = x.sum(axis=1) / n
+                y_center = y_mean
+                min_points = 2
+            else:
+                x_center = np.full(n.shape, pass_through[0], dtype=np.float64)
+                y_center = np.full(n.shape, pass_through[1], dtype=np.float64)
+                min_points = 1
+
+            dx = np.where(mask, x - x_center[:, np.newaxis], 0)
+            dy = np.where(mask, y - y_center[:, np.newaxis], 0)
+            slopes = (dx * dy).sum(axis=1) / (dx * dx).sum(axis=1)
+            intercepts = y_center - slopes * x_center
+
+            residuals = np.where(mask, y - (slopes[:, np.newaxis] * x
+                    + intercepts[:, np.newaxis]), 0)
+            deviations = np.where(mask, y - y_mean[:, np.newaxis], 0)
+            r_squared = 1 - (residuals**2).sum(axis=1) / (deviations**2).sum(axis=1)
+
+        too_few = n < min_points
+        slopes[too_few] = np.nan
+        intercepts[too_few] = np.nan
+        r_squared[too_few] = np.nan
+
+        return slopes, intercepts, r_squared
+
+    def get_robust_fit(x_series, y_series, pass_through=None, method='theil_sen', max_pairs=10**6, seed=None):
+        # Robust linear fit which isn't dragged around by outliers. Returns 
+        # the slope and y-intercept like get_linear_fit. Points where x or y 
+        # isn't finite are ignored.
+        #
+        # method is:
+        #  'theil_sen' slope is the median of the slopes between all pairs of 
+        #              points, intercept is the median of y - slope * x
+        #  'repeated_median' (Siegel) slope is the median over the points of 
+        #              the median slope from that point to all the others
+        #
+        # With a pass_through point both methods use the median of the slopes 
+        # from the pass_through point to each data point, which is exact 
+        # and O(n).
+        #
+        # The pairwise slopes are only all used when there are at most 
+        # max_pairs of them. Bigger series use max_pairs randomly drawn pairs 
+        # (theil_sen) or a random sample of points each with a random sample 
+        # of partners (repeated_median), so memory stays bounded. seed makes 
+        # the sampling reproducible.
+        x = np.asarray(x_series, dtype=np.float64)
+        y = np.asarray(y_series, dtype=np.float64)
+        valid = np.isfinite(x) & np.isfinite(y)
+        x = x[valid]
+        y = y[valid]
+        n = x.size
+
+        if method not in ('theil_sen', 'repeated_median'):
+            raise ValueError("Unknown robust method '{}'. Options are: theil_sen, repeated_median".format(method))
+
+        if pass_through:
+            ptx, pty = pass_through
+            dx = x - ptx
+            slopes = (y - pty)[dx != 0] / dx[dx != 0]
+            best_m = np.median(slopes) if slopes.size else np.nan
+            return best_m, pty - best_m * ptx
+
+        rng = np.random.default_rng(seed)
+        if method == 'theil_sen':
+            if n * (n - 1) // 2 <= max_pairs:
+                i, j = np.triu_indices(n, 1)
+            else:
+                i = rng.integers(0, n, max_pairs)
+                j = rng.integers(0, n - 1, max_pairs)
+                j += j >= i
+            dx = x[j] - x[i]
+            vertical = dx == 0
+            slopes = (y[j] - y[i])[~vertical] / dx[~vertical]
+            best_m = np.median(slopes) if slopes.size else np.nan
+        else:
+            if n * (n - 1) <= max_pairs:
+                rows = np.arange(n)
+                partners = np.broadcast_to(np.arange(n), (n, n))
+            else:
+                n_rows = min(n, max(int(max_pairs**.5), 1))
+                n_partners = min(n - 1, max(max_pairs // n_rows, 1))
+                rows = rng.choice(n, n_rows, replace=False)
+                partners = rng.integers(0, n - 1, (n_rows, n_partners))
+                partners += partners >= rows.reshape(-1,1)
+            dx = x[partners] - x[rows].reshape(-1,1)
+            dy = y[partners] - y[rows].reshape(-1,1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                slopes = np.where(dx != 0, dy / dx, np.nan)
+
+            # Skip points with no partners at a different x
+            slopes = slopes[~np.isnan(slopes).all(axis=1)]
+            row_medians = np.nanmedian(slopes, axis=1)
+            best_m = np.median(row_medians) if row_medians.size else np.nan
+
+        best_b = np.median(y - best_m * x) if n else np.nan
+        return best_m, best_b
+
     def get_linear_fit_series(axis, x_series, y_series, guess, pass_through=(0,0)):
         fit = Fitter.get_linear_fit(x_series, y_series, guess, pass_through)
         if VERBOSE:
@@ -125,6 +364,114 @@ class Fitter:
 
 
 
+class OnlineFitter:
+    # Least squares line (or power law) fit that is updated as data comes 
+    # in, such as discharge/stage pairs from a field logger, without keeping 
+    # the data. Only running sums are kept: the total weight, the means and 
+    # the centered second moments of x and y (weighted Welford updates, 
+    # which don't lose precision like raw sums of squares).
+    #
+    # log_space fits log10(y) against log10(x) like get_power_fit. Points 
+    # with x or y that isn't finite (or positive, in log space) are ignored.
+    #
+    # forgetting (0 < forgetting <= 1) multiplies the weight of everything 
+    # already seen by forgetting for every new point, so old data fades out 
+    # (exponential forgetting). 1 keeps all the data equally.
+
+    def __init__(self, log_space=False, forgetting=1.0):
+        self.log_space = log_space
+        self.forgetting = forgetting
+        self.n = 0 # number of points seen
+        self.weight = 0.0
+        self.x_mean = 0.0
+        self.y_mean = 0.0
+        self.xx = 0.0 # sum w (x - x_mean)**2
+        self.xy = 0.0 # sum w (x - x_mean) (y - y_mean)
+        self.yy = 0.0 # sum w (y - y_mean)**2
+
+    def add(self, x, y):
+        # Add a point or a chunk of points (arrays)
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        if self.log_space:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x = np.log10(x)
+                y = np.log10(y)
+        valid = np.isfinite(x) & np.isfinite(y)
+        x = x[valid]
+        y = y[valid]
+        k = x.size
+        if k == 0:
+            return self
+
+        # The newest point has weight 1 and the older points in the chunk 
+        # are faded like the existing data
+        weights = self.forgetting ** np.arange(k - 1, -1, -1, dtype=np.float64)
+        chunk_weight = weights.sum()
+        x_mean = (weights * x).sum() / chunk_weight
+        y_mean = (weights * y).sum() / chunk_weight
+        dx = x - x_mean
+        dy = y - y_mean
+
+        self._combine(self.forgetting**k, k, chunk_weight, x_mean, y_mean,
+                (weights * dx * dx).sum(), (weights * dx * dy).sum(),
+                (weights * dy * dy).sum())
+        return self
+
+    def merge(self, other):
+        # Add the data of another OnlineFitter (such as one from a parallel 
+        # worker) to this one. Both are treated as equally recent.
+        self._combine(1.0, other.n, other.weight, other.x_mean, other.y_mean,
+                other.xx, other.xy, other.yy)
+        return self
+
+    def _combine(self, fade, n, weight, x_mean, y_mean, xx, xy, yy):
+        # Merge the sums of a set of points into the running sums (Chan et 
+        # al. parallel update), fading the existing sums first
+        old_weight = self.weight * fade
+        total = old_weight + weight
+        if weight == 0:
+            return
+        dx = x_mean - self.x_mean
+        dy = y_mean - self.y_mean
+        scale = old_weight * weight / total
+
+        self.n += n
+        self.weight = total
+        self.x_mean += dx * weight / total
+        self.y_mean += dy * weight / total
+        self.xx = self.xx * fade + xx + dx * dx * scale
+        self.xy = self.xy * fade + xy + dx * dy * scale
+        self.yy = self.yy * fade + yy + dy * dy * scale
+
+    def get_fit(self, pass_through=None, return_power=True):
+        # Current fit. Returns the slope and y-intercept like get_linear_fit, 
+        # or a, b from y = ax^b in log space if return_power (like 
+        # get_power_fit). pass_through is an (x, y) point the line must pass 
+        # through (in linear space, also for log space fits).
+        if pass_through is None:
+            slope = self.xy / self.xx if self.xx else np.nan
+            intercept = self.y_mean - slope * self.x_mean
+        else:
+            px, py = np.log10(pass_through) if self.log_space else pass_through
+            dx = self.x_mean - px
+            dy = self.y_mean - py
+            sxx = self.xx + self.weight * dx * dx
+            sxy = self.xy + self.weight * dx * dy
+            slope = sxy / sxx if sxx else np.nan
+            intercept = py - slope * px
+
+        if self.log_space and return_power:
+            return 10**intercept, slope
+        return slope, intercept
+
+    def get_r_squared(self):
+        # R^2 of the current unconstrained fit
+        if not self.xx or not self.yy:
+            return np.nan
+        return self.xy**2 / (self.xx * self.yy)
+
+
 # For more functionality finish converting L3.py
 
 
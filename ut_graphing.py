@@ -2,6 +2,7 @@
 
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 #import pandas as pd
 
 import ut_fitting as utf
@@ -40,16 +41,16 @@ class Grapher:
         return self.point_format_iter
 
     def get_next_line_formats(self, n=1):
-        # Get the next n line formats. Returns a generator
-        iter = self.line_format_iter
+        # Get the next n line formats. Returns a generator. The iterator is 
+        # looked up for every item so the cycle continues after a reset.
         iter_reset = self.reset_line_format_iter
-        return (self._get_next(iter, iter_reset) for _ in range(n))
+        return (self._get_next(self.line_format_iter, iter_reset) for _ in range(n))
 
     def get_next_point_formats(self, n=1):
-        # Get the next n point formats. Returns a generator
-        iter = self.point_format_iter
+        # Get the next n point formats. Returns a generator. The iterator is 
+        # looked up for every item so the cycle continues after a reset.
         iter_reset = self.reset_point_format_iter
-        return (self._get_next(iter, iter_reset) for _ in range(n))
+        return (self._get_next(self.point_format_iter, iter_reset) for _ in range(n))
 
     def get_line_formats(self, n=1, return_str=True):
         list = ['{}{}'.format(c,l) for l, c in self.get_next_line_formats(n)]
@@ -123,11 +124,15 @@ class Grapher:
         #axis.set_xticks(xticks)
         #axis.set_yticks(yticks)
 
-    def pd_plot_cumsum(self, pd_data, title='', axis=None, logx=True, xticks=None, extras=False, show=False):
+    def pd_plot_cumsum(self, pd_data, title='', axis=None, logx=True, xticks=None, extras=False, show=False, high_volume=False, envelope=None):
         # Assumes cumsum is in the columns (col -> y values), row indices 
         # (first column) are the x values
         #
         # Meant for cumsum grain size distribution plotting
+        #
+        # high_volume draws all the columns as one LineCollection with an 
+        # optional percentile envelope instead of one line and legend entry 
+        # per column (see plot_line_collection)
 
         if not axis:
             extras = True
@@ -136,12 +141,15 @@ class Grapher:
             fig = plt.figure()
             axis = plt.gca()
 
-        # Generate a list of style strings
-        n_cols = pd_data.columns.size
-        styles = self.get_line_formats(n_cols)
+        if high_volume:
+            self.plot_line_collection(pd_data, axis, logx, envelope)
+        else:
+            # Generate a list of style strings
+            n_cols = pd_data.columns.size
+            styles = self.get_line_formats(n_cols)
 
-        # plot the pd dataframe
-        pd_data.plot(ax=axis, logx=logx, style=styles, legend=True)
+            # plot the pd dataframe
+            pd_data.plot(ax=axis, logx=logx, style=styles, legend=True)
 
         if xticks is not None:
             axis.set_xticks(xticks)
@@ -219,12 +227,15 @@ class Grapher:
         if show:
             plt.show()
 
-    def pd_plot(self, pd_data, title='', axis=None, logx=False, show=False):
+    def pd_plot(self, pd_data, title='', axis=None, logx=False, show=False, high_volume=False, envelope=None):
         # Assumes columns are y values, row indices (first column) are the x 
         # values
         #
         # Generic plotting of a pd dataframe (such as a multiple time series) 
         # using my custom formatting
+        #
+        # high_volume draws all the columns as one LineCollection (see 
+        # plot_line_collection)
 
         fig = None
         if not axis:
@@ -233,12 +244,15 @@ class Grapher:
             fig = plt.figure()
             axis = plt.gca()
 
-        # Generate a list of style strings
-        n_cols = pd_data.columns.size
-        styles = self.get_line_formats(n_cols)
+        if high_volume:
+            self.plot_line_collection(pd_data, axis, logx, envelope)
+        else:
+            # Generate a list of style strings
+            n_cols = pd_data.columns.size
+            styles = self.get_line_formats(n_cols)
 
-        # plot the pd dataframe
-        pd_data.plot(ax=axis, logx=logx, style=styles, legend=True)
+            # plot the pd dataframe
+            pd_data.plot(ax=axis, logx=logx, style=styles, legend=True)
 
         if show:
             plt.show()
@@ -246,6 +260,64 @@ class Grapher:
         if fig is not None:
             return fig, axis
 
+    def plot_line_collection(self, pd_data, axis=None, logx=False, envelope=None, linewidth=0.5, alpha=0.3, rasterized=True):
+        # Draw every column of pd_data (row indices are the x values) as one 
+        # LineCollection, for plotting thousands of runs. Colors and line 
+        # styles come from the line_formats cycle like pd_plot.
+        #
+        # There is no legend entry per column. envelope is a list of 
+        # percents (such as [5, 25, 50, 75, 95]); the percentiles of the 
+        # columns at each x are drawn on top, with the bands between 
+        # matching low and high percents filled and a middle percent drawn 
+        # as a line, each with one legend entry.
+        #
+        # rasterized draws the lines as an image in vector outputs (svg, 
+        # pdf), so the file size depends on the figure size instead of the 
+        # number of lines.
+        #
+        # Returns the LineCollection.
+        if axis is None:
+            axis = plt.gca()
+
+        x = np.asarray(pd_data.index.values, dtype=np.float64)
+        values = np.asarray(pd_data.values, dtype=np.float64)
+        n_cols = values.shape[1]
+
+        segments = np.empty((n_cols, x.size, 2))
+        segments[:, :, 0] = x
+        segments[:, :, 1] = values.T
+
+        formats = list(self.get_next_line_formats(n_cols))
+        lines = LineCollection(segments,
+                colors=[color for style, color in formats],
+                linestyles=[style for style, color in formats],
+                linewidths=linewidth, alpha=alpha, rasterized=rasterized,
+                label="{} runs".format(n_cols))
+        axis.add_collection(lines)
+
+        if logx:
+            axis.set_xscale('log')
+        axis.autoscale_view()
+
+        if envelope is not None:
+            percents = sorted(envelope)
+            with np.errstate(invalid='ignore'):
+                bounds = np.nanpercentile(values, percents, axis=1)
+
+            n_bands = len(percents) // 2
+            for band in range(n_bands):
+                low = percents[band]
+                high = percents[-1 - band]
+                axis.fill_between(x, bounds[band], bounds[-1 - band],
+                        color='k', alpha=0.15, linewidth=0,
+                        label="{}-{}%".format(low, high))
+            if len(percents) % 2:
+                axis.plot(x, bounds[n_bands], color='k', linestyle='-',
+                        label="{}%".format(percents[n_bands]))
+            axis.legend()
+
+        return lines
+
 
     # Helper class functions
     def calc_log_boundaries(value, lower=True):
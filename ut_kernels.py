@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+import math
+import os
+import warnings
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Loop kernels for PiecewiseLinearCDF.evaluate (used by convert),
+# PiecewiseLinearCDF.invert (percentile sizes) and the pairwise distances of
+# ks_test and compare_distributions.
+#
+# There are two backends with the same results:
+#  'numpy' array versions. These make temporaries the size of the output
+#          (or of a distance tile for every size class).
+#  'numba' compiled loops which write straight into the output. Only
+#          available if numba is installed.
+#
+# Results have the dtype of the line or distribution arrays (float32 or
+# float64).
+#
+# The default 'auto' uses numba when it is installed and numpy otherwise.
+# Use set_backend (or use_backend) to force one, such as for checking that
+# both give the same results or timing them. The starting value can be set
+# with the UT_KERNELS_BACKEND environment variable, which is also how
+# process pool workers can be given a backend. An unknown name there, or
+# 'numba' without numba installed, falls back to numpy with a warning.
+
+backends = ('auto', 'numpy', 'numba')
+backend = 'auto'
+
+def set_backend(name):
+    global backend
+    if name not in backends:
+        raise ValueError("Unknown backend '{}'. Options are: {}".format(
+            name, ', '.join(backends)))
+    if name == 'numba' and numba is None:
+        raise ValueError("The numba backend needs numba to be installed")
+    backend = name
+
+def get_backend():
+    # Name of the backend in use ('numpy' or 'numba')
+    if backend == 'auto':
+        return 'numpy' if numba is None else 'numba'
+    return backend
+
+def _set_env_backend():
+    # Starting backend from the UT_KERNELS_BACKEND environment variable
+    name = os.environ.get('UT_KERNELS_BACKEND') or 'auto'
+    try:
+        set_backend(name)
+    except ValueError as error:
+        warnings.warn("UT_KERNELS_BACKEND: {}. Using the numpy backend.".format(error))
+        set_backend('numpy')
+
+_set_env_backend()
+
+@contextmanager
+def use_backend(name):
+    # Use a backend for a with block
+    previous = backend
+    set_backend(name)
+    try:
+        yield
+    finally:
+        set_backend(previous)
+
+
+# Numpy backend
+def _evaluate_numpy(breakpoints, slopes, intercepts, sizes):
+    arg_index = np.searchsorted(breakpoints[:-1], sizes, side='left') - 1
+
+    m = slopes[arg_index, :]
+    b = intercepts[arg_index, :]
+
+    return (m * sizes.reshape(-1,1) + b).astype(slopes.dtype, copy=False)
+
+def _invert_numpy(fractions, slopes, intercepts, targets):
+    n_sizes, n_runs = fractions.shape
+
+    envelope = np.maximum.accumulate(fractions, axis=0)
+    upper = np.empty((targets.size, n_runs), dtype=np.intp)
+    for run in range(n_runs):
+        upper[:, run] = np.searchsorted(envelope[:, run], targets, side='right')
+
+    # No crossing if the first row is already above the target or if the
+    # run never gets above it
+    found = (upper > 0) & (upper < n_sizes)
+    segment = np.where(found, upper - 1, 0)
+    runs = np.arange(n_runs)
+
+    m = slopes[segment, runs]
+    b = intercepts[segment, runs]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values = (targets.reshape(-1,1) - b) / m
+    values[~found] = np.nan
+
+    return values.astype(fractions.dtype, copy=False)
+
+
+# Numba backend. The loops do the same operations in the same order as the
+# numpy versions so the results are identical, including NaN handling.
+if numba is not None:
+
+    @numba.njit(cache=True, error_model='numpy')
+    def _evaluate_numba(breakpoints, slopes, intercepts, sizes, out):
+        n_starts = breakpoints.size - 1
+        n_runs = slopes.shape[1]
+        for i in range(sizes.size):
+            size = sizes[i]
+
+            # searchsorted(breakpoints[:-1], size, side='left') - 1, with
+            # the last segment used for -1 like numpy indexing
+            lo = 0
+            hi = n_starts
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if not breakpoints[mid] >= size:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            segment = lo - 1 if lo > 0 else n_starts - 1
+
+            for run in range(n_runs):
+                out[i, run] = slopes[segment, run] * size + intercepts[segment, run]
+
+    @numba.njit(cache=True, error_model='numpy')
+    def _invert_numba(fractions, slopes, intercepts, targets, out):
+        n_sizes, n_runs = fractions.shape
+        for run in range(n_runs):
+            for t in range(targets.size):
+                target = targets[t]
+
+                # First size where the running max rises above the target.
+                # NaN counts as above everything, like in searchsorted.
+                upper = n_sizes
+                envelope = -np.inf
+                for i in range(n_sizes):
+                    value = fractions[i, run]
+                    if value != value:
+                        upper = i
+                        break
+                    if value > envelope:
+                        envelope = value
+                    if envelope > target:
+                        upper = i
+                        break
+
+                if 0 < upper < n_sizes:
+                    segment = upper - 1
+                    out[t, run] = (target - intercepts[segment, run]) / slopes[segment, run]
+                else:
+                    out[t, run] = np.nan
+
+    @numba.njit(cache=True, error_model='numpy')
+    def _pair_distances_numba(A_block, B_block, weights, kind, zero, out):
+        # kind is the index in _numba_metrics. zero sets the type the sums
+        # are accumulated in (the out dtype, like the numpy version).
+        n_sizes, n_A = A_block.shape
+        n_B = B_block.shape[1]
+        for a in range(n_A):
+            for b in range(n_B):
+                total = zero
+                for size in range(n_sizes):
+                    diff = A_block[size, a] - B_block[size, b]
+                    if kind == 0:
+                        total += abs(diff)
+                    elif kind == 1:
+                        diff = abs(diff)
+                        if total == total and (diff > total or diff != diff):
+                            total = diff
+                    elif kind == 2:
+                        total += weights[size] * abs(diff)
+                    else:
+                        total += weights[size] * (diff * diff)
+                if kind == 0 or kind == 3:
+                    out[a, b] = math.sqrt(total)
+                else:
+                    out[a, b] = total
+
+# Metrics (by ut_metrics name) with a numba distance kernel
+_numba_metrics = ('sqrt_sum', 'ks', 'wasserstein', 'l2')
+
+
+def evaluate(breakpoints, slopes, intercepts, sizes):
+    # Evaluate piecewise lines at sizes (see PiecewiseLinearCDF.evaluate).
+    # Returns an array (n sizes x n runs).
+    sizes = np.asarray(sizes, dtype=np.float64)
+    if get_backend() == 'numpy':
+        return _evaluate_numpy(breakpoints, slopes, intercepts, sizes)
+
+    out = np.empty((sizes.size, slopes.shape[1]), dtype=slopes.dtype)
+    _evaluate_numba(breakpoints, slopes, intercepts, sizes, out)
+    return out
+
+def invert(fractions, slopes, intercepts, targets):
+    # Sizes where piecewise lines first rise above the targets (see
+    # PiecewiseLinearCDF.invert). Returns an array (n targets x n runs).
+    targets = np.asarray(targets, dtype=np.float64)
+    if get_backend() == 'numpy':
+        return _invert_numpy(fractions, slopes, intercepts, targets)
+
+    out = np.empty((targets.size, fractions.shape[1]), dtype=fractions.dtype)
+    _invert_numba(fractions, slopes, intercepts, targets, out)
+    return out
+
+def pair_distances(metric, A_block, B_block, weights, out=None):
+    # Distances (a ut_metrics.Metric) between every pair of A and B columns,
+    # written into out (n A x n B) if given. Metrics without a numba kernel
+    # always use metric.distances. Weights are cast to the block dtype so
+    # float32 blocks are summed in float32.
+    dtype = np.result_type(A_block, B_block)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=dtype)
+    if get_backend() == 'numpy' or metric.name not in _numba_metrics:
+        distances = metric.distances(A_block, B_block, weights)
+        if out is None:
+            return distances
+        out[...] = distances
+        return out
+
+    if out is None:
+        out = np.empty((A_block.shape[1], B_block.shape[1]), dtype=dtype)
+    if weights is None:
+        weights = np.ones(A_block.shape[0], dtype=dtype)
+    _pair_distances_numba(A_block, B_block, weights,
+            _numba_metrics.index(metric.name), dtype.type(0), out)
+    return out
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+# Distance metrics between normalized cumsum distributions which share the
+# same grain size classes. Used by PDDistributions.ks_test,
+# compare_distributions and nearest_distributions, which take care of
+# normalizing, converting size classes and splitting the runs into tiles.
+#
+# Every metric works on one tile at a time: A_block and B_block are
+# (size classes x runs) arrays and the result is an (A runs x B runs) array.
+# The size classes are accumulated one at a time, so memory only scales with
+# the tile and the addition order doesn't depend on the tile shape.
+#
+# Weights are per size class. Integrated metrics use trapezoid weights along
+# the log2 grain size (psi) axis, the others use ones.
+
+class Metric:
+    # A named metric. distances(A_block, B_block, weights) gives the scores
+    # for every pair in a tile. lower_bound(total_difference, weights) gives
+    # a bound on the score from the difference of the weighted column totals
+    # of the two distributions, |sum(w*a) - sum(w*b)|, which is used to skip
+    # pairs in nearest_distributions. combine(first, second) gives a lower
+    # bound on the score from scores (or bounds) over two disjoint sets of
+    # size classes, such as the probe classes and the rest. integrated says
+    # whether the metric uses log size weights.
+
+    __slots__ = ('name', 'distances', 'lower_bound', 'combine', 'integrated')
+
+    def __init__(self, name, distances, lower_bound, combine, integrated=False):
+        self.name = name
+        self.distances = distances
+        self.lower_bound = lower_bound
+        self.combine = combine
+        self.integrated = integrated
+
+    def get_weights(self, sizes):
+        # Weights for the given grain size classes
+        sizes = np.asarray(sizes, dtype=np.float64)
+        if not self.integrated:
+            return np.ones(sizes.size)
+
+        # Trapezoid rule along psi = log2(D)
+        psi = np.log2(sizes)
+        half_widths = np.diff(psi) / 2
+        weights = np.zeros(sizes.size)
+        weights[:-1] += half_widths
+        weights[1:] += half_widths
+        return weights
+
+
+def _row_pairs(A_block, B_block):
+    # Yield the (A runs x B runs) differences one size class at a time, with
+    # the size class index
+    A_block = A_block[:,:,np.newaxis]
+    B_block = B_block[:,np.newaxis,:]
+    for size in range(A_block.shape[0]):
+        yield size, A_block[size] - B_block[size]
+
+def sqrt_sum_distances(A_block, B_block, weights=None):
+    # Square root of the summed absolute differences. This is the original
+    # ks_test score; it isn't a true K-S statistic.
+    dist_sum = None
+    for size, diff in _row_pairs(A_block, B_block):
+        if dist_sum is None:
+            dist_sum = np.absolute(diff)
+        else:
+            dist_sum += np.absolute(diff)
+    return dist_sum**.5
+
+def ks_distances(A_block, B_block, weights=None):
+    # Kolmogorov-Smirnov statistic: the largest absolute difference between
+    # the cumsums
+    sup = None
+    for size, diff in _row_pairs(A_block, B_block):
+        if sup is None:
+            sup = np.absolute(diff)
+        else:
+            np.maximum(sup, np.absolute(diff), out=sup)
+    return sup
+
+def wasserstein_distances(A_block, B_block, weights):
+    # 1-D Wasserstein (earth mover's) distance: the absolute difference
+    # between the cumsums integrated along the psi axis (psi units)
+    dist_sum = None
+    for size, diff in _row_pairs(A_block, B_block):
+        if dist_sum is None:
+            dist_sum = weights[size] * np.absolute(diff)
+        else:
+            dist_sum += weights[size] * np.absolute(diff)
+    return dist_sum
+
+def l2_distances(A_block, B_block, weights):
+    # L2 distance: square root of the squared cumsum difference integrated
+    # along the psi axis
+    dist_sum = None
+    for size, diff in _row_pairs(A_block, B_block):
+        if dist_sum is None:
+            dist_sum = weights[size] * diff**2
+        else:
+            dist_sum += weights[size] * diff**2
+    return dist_sum**.5
+
+
+# Lower bounds from the weighted total difference, |sum(w*d)| where d = a - b
+#  sqrt_sum: sum|d| >= |sum(d)|
+#  ks: max|d| >= |sum(d)| / n
+#  wasserstein: sum(w|d|) >= |sum(w*d)|
+#  l2: sum(w*d**2) >= sum(w*d)**2 / sum(w)   (Cauchy-Schwarz)
+#
+# Combining scores over disjoint sets of size classes
+#  sqrt_sum, l2: square root of the summed squares
+#  ks: the larger of the two
+#  wasserstein: the sum
+def _root_sum_squares(first, second):
+    return (first**2 + second**2)**.5
+
+metrics = {metric.name : metric for metric in [
+    Metric('sqrt_sum', sqrt_sum_distances,
+        lambda total, weights: total**.5, _root_sum_squares),
+    Metric('ks', ks_distances,
+        lambda total, weights: total / weights.size, np.maximum),
+    Metric('wasserstein', wasserstein_distances,
+        lambda total, weights: total, np.add, integrated=True),
+    Metric('l2', l2_distances,
+        lambda total, weights: total / np.sum(weights)**.5, _root_sum_squares,
+        integrated=True),
+    ]}
+
+def get_metric(name):
+    # Look up a metric by name
+    try:
+        return metrics[name]
+    except KeyError:
+        raise ValueError("Unknown metric '{}'. Options are: {}".format(
+            name, ', '.join(metrics))) from None
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+class DistributionStore:
+
+    # On-disk storage for collections of grain size distributions which are
+    # too big to keep in memory. Arrays are memory mapped (np.memmap), so
+    # only the parts which are used get read from disk, and
+    # PDDistributions.from_store can wrap them without copying.
+    #
+    # A store is a directory:
+    #  meta.json   max_size, cumsummed flag and run labels
+    #  sizes.npy   grain size classes (including the max_size row)
+    #  mass.npy    mass (or cumsum) data, n_sizes x n_runs
+    #  cumsum.npy  optional normalized cumsum, n_sizes x n_runs
+    #
+    # The 2D arrays are stored in Fortran (column) order, so each run is one
+    # contiguous block on disk and reading a few runs only pages in those
+    # runs.
+
+    meta_name = 'meta.json'
+    sizes_name = 'sizes.npy'
+    mass_name = 'mass.npy'
+    cumsum_name = 'cumsum.npy'
+
+    def __init__(self, path, mode='r'):
+        # Open an existing store. mode is the np.memmap mode for the mass
+        # and cumsum arrays ('r' read only, 'r+' read/write, 'c' copy on
+        # write).
+        self.path = path
+
+        with open(os.path.join(path, DistributionStore.meta_name)) as meta_file:
+            meta = json.load(meta_file)
+        self.max_size = meta['max_size']
+        self.cumsummed = meta['cumsummed']
+        self.runs = pd.Index(meta['runs'])
+
+        self.sizes = np.load(os.path.join(path, DistributionStore.sizes_name))
+        self.mass = np.load(os.path.join(path, DistributionStore.mass_name),
+                mmap_mode=mode)
+
+        cumsum_path = os.path.join(path, DistributionStore.cumsum_name)
+        if os.path.exists(cumsum_path):
+            self.cumsum = np.load(cumsum_path, mmap_mode=mode)
+        else:
+            self.cumsum = None
+
+    def create(path, sizes, runs, max_size, cumsummed=False, with_cumsum=False, dtype=np.float64):
+        # Make a new store filled with zeros and open it for writing. Meant
+        # for filling a large store a block of runs at a time with
+        # write_runs. sizes must include the max_size row. dtype is the float
+        # type of the mass and cumsum arrays.
+        os.makedirs(path, exist_ok=True)
+        sizes = np.asarray(sizes, dtype=np.float64)
+        runs = pd.Index(runs)
+        shape = (sizes.size, runs.size)
+
+        meta = {
+                'max_size' : max_size,
+                'cumsummed' : cumsummed,
+                'runs' : runs.tolist(),
+                }
+        with open(os.path.join(path, DistributionStore.meta_name), 'w') as meta_file:
+            json.dump(meta, meta_file)
+        np.save(os.path.join(path, DistributionStore.sizes_name), sizes)
+
+        names = [DistributionStore.mass_name]
+        if with_cumsum:
+            names.append(DistributionStore.cumsum_name)
+        for name in names:
+            array = np.lib.format.open_memmap(os.path.join(path, name),
+                    mode='w+', dtype=dtype, shape=shape, fortran_order=True)
+            array.flush()
+            del array
+
+        return DistributionStore(path, mode='r+')
+
+    def write(path, distributions, with_cumsum=False):
+        # Save a PDDistributions as a new store and return it (open for
+        # writing). with_cumsum also saves the normalized cumsum.
+        store = DistributionStore.create(path, distributions.get_size_classes(),
+                distributions.data.columns, distributions.max_size,
+                distributions.cumsummed, with_cumsum, distributions.dtype)
+
+        cumsum = distributions.cumsum.values if with_cumsum else None
+        store.write_runs(0, distributions.data.values, cumsum)
+        store.flush()
+
+        return store
+
+    def write_runs(self, start, mass, cumsum=None):
+        # Write a block of runs (columns) starting at run number start
+        stop = start + mass.shape[1]
+        self.mass[:, start:stop] = mass
+        if cumsum is not None:
+            self.cumsum[:, start:stop] = cumsum
+
+    def flush(self):
+        for array in (self.mass, self.cumsum):
+            if isinstance(array, np.memmap):
+                array.flush()
+
+    def get_n_runs(self):
+        return self.runs.size